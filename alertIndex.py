@@ -0,0 +1,193 @@
+## alertIndex keeps a SQLite database of every alert Boiler has put on the feed, active, archived or deleted, so questions like "every TOR for state 40
+## in May" or "everything WXYZ relayed" are answered from an index instead of opening every response.json in archive_dir. feedManagement keeps it up
+## to date as alerts are added and expire, webProcess answers queries on /api/alerts, and running this file queries it or rebuilds it from disk.
+import argparse, json, logging, os, sqlite3, sys, threading
+import datetime as dt
+
+log = logging.getLogger(__name__)
+
+MAX_LIMIT = 1000
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS alerts (
+    id TEXT PRIMARY KEY,
+    hash TEXT,
+    event TEXT,
+    originator TEXT,
+    callsign TEXT COLLATE NOCASE,
+    start_epoch REAL,
+    end_epoch REAL,
+    status TEXT
+);
+CREATE TABLE IF NOT EXISTS alert_fips (
+    alert_id TEXT,
+    fips TEXT,
+    state TEXT,
+    PRIMARY KEY (alert_id, fips)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS alerts_start ON alerts (start_epoch);
+CREATE INDEX IF NOT EXISTS alerts_event ON alerts (event, start_epoch);
+CREATE INDEX IF NOT EXISTS alerts_originator ON alerts (originator, start_epoch);
+CREATE INDEX IF NOT EXISTS alerts_callsign ON alerts (callsign, start_epoch);
+CREATE INDEX IF NOT EXISTS alerts_hash ON alerts (hash);
+CREATE INDEX IF NOT EXISTS alert_fips_fips ON alert_fips (fips, alert_id);
+CREATE INDEX IF NOT EXISTS alert_fips_state ON alert_fips (state, alert_id);
+"""
+
+_local = threading.local() # One connection per thread and database path.
+
+def connect(path:str):
+    '''Returns this thread's connection to the index at path, creating the database if it doesn't exist yet.'''
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    connection = connections.get(path)
+    if connection is None:
+        connection = sqlite3.connect(path, timeout=10)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL") # Readers in the web workers never block boiler.py writing, or the other way around.
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+        connections[path] = connection
+    return connection
+
+def _epoch(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _add(connection, alert_json:dict, status:str):
+    alert_id = str(alert_json.get("id"))
+    connection.execute(
+        "INSERT INTO alerts (id, hash, event, originator, callsign, start_epoch, end_epoch, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (id) DO UPDATE SET hash = excluded.hash, event = excluded.event, originator = excluded.originator, callsign = excluded.callsign, "
+        "start_epoch = excluded.start_epoch, end_epoch = excluded.end_epoch, status = excluded.status",
+        (alert_id, alert_json.get("hash"), alert_json.get("type"), alert_json.get("originator"), str(alert_json.get("callsign") or "").strip(),
+         _epoch(alert_json.get("startTimeEpoch")), _epoch(alert_json.get("endTimeEpoch")), status)
+    )
+    connection.execute("DELETE FROM alert_fips WHERE alert_id = ?", (alert_id,))
+    fips_codes = set(str(fips) for fips in alert_json.get("fipsCodes") or ())
+    connection.executemany("INSERT INTO alert_fips (alert_id, fips, state) VALUES (?, ?, ?)", [(alert_id, fips, fips[1:3]) for fips in fips_codes])
+
+def add(path:str, alert_json:dict, status:str = "active"):
+    '''Adds an alert (its response.json) to the index, or updates it if it's already there.'''
+    connection = connect(path)
+    with connection:
+        _add(connection, alert_json, status)
+
+def set_status(path:str, alert_id, status:str):
+    '''Marks an alert as "archived" or "deleted" once it comes off the feed.'''
+    connection = connect(path)
+    with connection:
+        connection.execute("UPDATE alerts SET status = ? WHERE id = ?", (status, str(alert_id)))
+
+def parse_time(value:str):
+    '''Turns a query time (epoch seconds, or an ISO 8601 date or time, UTC unless it says otherwise) into epoch seconds.'''
+    if value is None or value == "":
+        return None
+    epoch = _epoch(value)
+    if epoch is not None:
+        return epoch
+    parsed = dt.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=dt.timezone.utc)
+    return parsed.timestamp()
+
+def query(path:str, event:str = None, originator:str = None, callsign:str = None, fips:str = None, state:str = None, status:str = None,
+          since = None, until = None, limit:int = 100, offset:int = 0):
+    '''Returns {"total", "limit", "offset", "alerts"} for the alerts matching every filter that's set, newest first. since/until are compared against
+    the alert's start time and take anything parse_time() does. callsign matches with or without the part after the slash (WXYZ finds WXYZ/FM).'''
+    clauses, parameters = [], []
+    for column, value in (("event", event), ("originator", originator), ("status", status)):
+        if value:
+            clauses.append(f"a.{column} = ?")
+            parameters.append(value)
+    if callsign:
+        clauses.append("(a.callsign = ? OR a.callsign LIKE ?)")
+        parameters += [callsign, f"{callsign}/%"]
+    if fips:
+        clauses.append("a.id IN (SELECT alert_id FROM alert_fips WHERE fips = ?)")
+        parameters.append(fips)
+    if state:
+        clauses.append("a.id IN (SELECT alert_id FROM alert_fips WHERE state = ?)")
+        parameters.append(str(state).zfill(2))
+    since, until = parse_time(since), parse_time(until)
+    if since is not None:
+        clauses.append("a.start_epoch >= ?")
+        parameters.append(since)
+    if until is not None:
+        clauses.append("a.start_epoch < ?")
+        parameters.append(until)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    limit = min(max(int(limit), 1), MAX_LIMIT)
+    offset = max(int(offset), 0)
+    connection = connect(path)
+    total = connection.execute(f"SELECT COUNT(*) FROM alerts a {where}", parameters).fetchone()[0]
+    rows = connection.execute(f"SELECT a.* FROM alerts a {where} ORDER BY a.start_epoch DESC, a.id DESC LIMIT ? OFFSET ?", parameters + [limit, offset]).fetchall()
+    fips_by_alert = {}
+    if rows:
+        ids = [row["id"] for row in rows]
+        for fips_row in connection.execute(f"SELECT alert_id, fips FROM alert_fips WHERE alert_id IN ({','.join('?' * len(ids))})", ids):
+            fips_by_alert.setdefault(fips_row["alert_id"], []).append(fips_row["fips"])
+    alerts = []
+    for row in rows:
+        alert = dict(row)
+        alert["fips"] = sorted(fips_by_alert.get(row["id"], []))
+        alerts.append(alert)
+    return {"total": total, "limit": limit, "offset": offset, "alerts": alerts}
+
+def rebuild(path:str, alerts_dir:str, archive_dir:str):
+    '''Indexes every alert on disk: active ones in alerts_dir, and archived ones in archive_dir (segments and old-style directories). Returns how many were indexed.'''
+    import archiveStore
+    connection = connect(path)
+    indexed = 0
+    with connection:
+        for directory, status in ((archive_dir, "archived"), (alerts_dir, "active")):
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                alert_json_path = os.path.join(directory, name, "response.json")
+                if not os.path.isfile(alert_json_path):
+                    continue
+                with open(alert_json_path, "r") as alert_json_file:
+                    _add(connection, json.load(alert_json_file), status)
+                    alert_json_file.close()
+                indexed += 1
+            if status == "archived":
+                for alert_id in archiveStore.alert_ids(directory):
+                    header, files = archiveStore.read(directory, alert_id)
+                    if "response.json" in files:
+                        _add(connection, json.loads(files["response.json"]), status)
+                        indexed += 1
+    return indexed
+
+def main():
+    import configManager
+    parser = argparse.ArgumentParser(description="Query the alert index, or rebuild it from the alerts and archive directories.")
+    parser.add_argument("--config", default="boiler.cfg", help="Path to boiler.cfg")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("rebuild", help="Index every alert in alerts_dir and archive_dir")
+    query_parser = commands.add_parser("query", help="Print the alerts matching the filters as JSON lines, newest first")
+    for name, help in (("--event", "Event code, like TOR"), ("--originator", "Originator code, like WXR"), ("--callsign", "Station that relayed the alert"),
+                       ("--fips", "SAME FIPS code, like 040109"), ("--state", "State FIPS code, like 40"), ("--status", "active, archived or deleted"),
+                       ("--since", "Alerts that started at or after this time (ISO 8601 or epoch seconds, UTC)"), ("--until", "Alerts that started before this time")):
+        query_parser.add_argument(name, help=help)
+    query_parser.add_argument("--limit", type=int, default=100, help=f"Alerts per page (default 100, at most {MAX_LIMIT})")
+    query_parser.add_argument("--offset", type=int, default=0, help="Alerts to skip, for the next page")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    config = configManager.load(args.config)
+    path = config["index"]["path"]
+    if args.command == "rebuild":
+        print(f"Indexed {rebuild(path, config['alerts_dir'], config['archive_dir'])} alert(s) into {path}.")
+        return 0
+    result = query(path, event=args.event, originator=args.originator, callsign=args.callsign, fips=args.fips, state=args.state, status=args.status,
+                   since=args.since, until=args.until, limit=args.limit, offset=args.offset)
+    for alert in result["alerts"]:
+        print(json.dumps(alert))
+    print(f"{len(result['alerts'])} of {result['total']} alert(s), starting at {result['offset']}.", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+## alertRegistry keeps track of which alerts are stored and which CAR entries have already been handled, so that polls don't need to touch the disk to find out.
+import json, logging, os, threading
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+stored = {} # Alert ID -> hash of the version stored in alerts_dir.
+seen = set() # (id, hash) of every entry from the previous poll that has already been through the pipeline.
+loaded_dir = None
+_seen_filter_generation = None
+
+def _key(entry:dict):
+    return (str(entry.get("id")), str(entry.get("hash")))
+
+def rebuild(alerts_dir:str):
+    '''Scans alerts_dir once and records every alert that has both its response.json and alert.xml. Called on startup (or if alerts_dir changes); after that the registry is kept up to date by store_alert() and update_feed().'''
+    global loaded_dir
+    new_stored = {}
+    if os.path.isdir(alerts_dir):
+        for alert_id in os.listdir(alerts_dir):
+            alert_path = os.path.join(alerts_dir, alert_id)
+            alert_json_path = os.path.join(alert_path, "response.json")
+            alert_xml_path = os.path.join(alert_path, "alert.xml")
+            if not (os.path.exists(alert_json_path) and os.path.exists(alert_xml_path)):
+                continue
+            try:
+                with open(alert_json_path, "r") as alert_json_file:
+                    alert_json = json.load(alert_json_file)
+                    alert_json_file.close()
+                new_stored[str(alert_json.get("id", alert_id))] = str(alert_json.get("hash"))
+            except:
+                log.warning(f"Couldn't read {alert_json_path}, it will be treated as not stored.", exc_info=True)
+    with _lock:
+        stored.clear()
+        stored.update(new_stored)
+        seen.clear()
+        loaded_dir = alerts_dir
+    log.info(f"Alert registry loaded {len(stored)} stored alert(s) from {alerts_dir}.")
+
+def ensure_loaded(alerts_dir:str):
+    if loaded_dir != alerts_dir:
+        rebuild(alerts_dir)
+
+def is_stored(entry:dict):
+    '''True if this exact version (id and hash) of the alert is already stored.'''
+    alert_id, alert_hash = _key(entry)
+    return stored.get(alert_id) == alert_hash
+
+def add(entry:dict):
+    alert_id, alert_hash = _key(entry)
+    with _lock:
+        stored[alert_id] = alert_hash
+
+def remove(alert_id:str):
+    with _lock:
+        stored.pop(str(alert_id), None)
+
+def forget(entry:dict):
+    '''Drops an entry from the seen set so it goes through the whole pipeline again on the next poll. Used when storing it failed.'''
+    with _lock:
+        seen.discard(_key(entry))
+
+def diff(feed_CAR:list, filter_generation = None):
+    '''Compares this poll against the previous one and returns only the entries that are new or have changed. Unchanged entries cost a set lookup.
+
+    If filter_generation is different from the last call, everything is treated as new, since entries that were blocked before might not be anymore.'''
+    global _seen_filter_generation
+    with _lock:
+        if filter_generation != _seen_filter_generation:
+            if _seen_filter_generation is not None:
+                log.info("Filters have changed, re-checking every active alert.")
+            seen.clear()
+            _seen_filter_generation = filter_generation
+        current = {}
+        for entry in feed_CAR:
+            current.setdefault(_key(entry), entry)
+        new_keys = current.keys() - seen
+        seen.clear() # Entries that dropped off of CAR are forgotten along the way.
+        seen.update(current.keys())
+    return [entry for key, entry in current.items() if key in new_keys]
@@ -0,0 +1,273 @@
+## archiveStore keeps expired alerts in a handful of large segment files instead of one directory per alert, which gets painful to list and back up
+## after a year or so of alerts. Each expired alert is appended to the newest segment as a single record (its response.json, alert.xml and, if
+## enabled, its audio), and every segment has a small index file next to it with the offset of each record, so any alert can be read back by ID
+## without scanning. A new segment is started once the current one gets too big or too old.
+##
+## Record layout: MAGIC, a 4 byte little-endian header length, a JSON header ({"id", "hash", "archived", "files": [[name, size], ...]}), then the
+## contents of each file back to back. Index lines are "<id>\t<offset>\t<length>\n". Run this file to pack old archive directories, or list/extract alerts.
+import argparse, glob, json, logging, os, shutil, struct, sys, threading
+import datetime as dt
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"BOILREC1"
+SEGMENT_PREFIX = "archive-"
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+METADATA_FILES = ("response.json", "alert.xml")
+AUDIO_SUFFIX = ".mp3"
+
+_lock = threading.Lock()
+_indexes = {} # Segment path -> (index file size, {alert ID: (offset, length)})
+
+def _segments(archive_dir:str):
+    '''Segment paths in the archive, oldest first. The name carries the time the segment was started, so sorting by name sorts by age.'''
+    return sorted(glob.glob(os.path.join(archive_dir, f"{SEGMENT_PREFIX}*{SEGMENT_SUFFIX}")))
+
+def _index_path(segment_path:str):
+    return segment_path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+
+def _segment_started(segment_path:str):
+    name = os.path.basename(segment_path)[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]
+    try:
+        return dt.datetime.strptime(name[:15], "%Y%m%d-%H%M%S").replace(tzinfo=dt.timezone.utc)
+    except ValueError:
+        return None
+
+def _new_segment(archive_dir:str):
+    now = dt.datetime.now(tz=dt.timezone.utc)
+    count = 0
+    segment_path = os.path.join(archive_dir, f"{SEGMENT_PREFIX}{now:%Y%m%d-%H%M%S}-{count:03d}{SEGMENT_SUFFIX}")
+    while os.path.exists(segment_path): # Rolled twice within a second.
+        count += 1
+        segment_path = os.path.join(archive_dir, f"{SEGMENT_PREFIX}{now:%Y%m%d-%H%M%S}-{count:03d}{SEGMENT_SUFFIX}")
+    open(segment_path, "ab").close()
+    open(_index_path(segment_path), "ab").close()
+    log.info(f"Started new archive segment {segment_path}.")
+    return segment_path
+
+def _read_index(segment_path:str):
+    '''Returns {alert ID: (offset, length)} for a segment, only re-reading the index file if it grew.'''
+    index_path = _index_path(segment_path)
+    try:
+        size = os.path.getsize(index_path)
+    except FileNotFoundError:
+        return {}
+    cached = _indexes.get(segment_path)
+    if cached and cached[0] == size:
+        return cached[1]
+    entries = {}
+    with open(index_path, "r") as index_file:
+        for line in index_file:
+            parts = line.rstrip("\n").split("\t")
+            if not line.endswith("\n") or len(parts) != 3: # Torn last line, fixed up by the next append.
+                continue
+            entries[parts[0]] = (int(parts[1]), int(parts[2]))
+        index_file.close()
+    _indexes[segment_path] = (size, entries)
+    return entries
+
+def _scan(segment_file, start:int):
+    '''Yields (offset, length, header) for every complete record from start on. Stops at the first incomplete or damaged one.'''
+    segment_file.seek(0, os.SEEK_END)
+    end = segment_file.tell()
+    offset = start
+    while offset + len(MAGIC) + 4 <= end:
+        segment_file.seek(offset)
+        if segment_file.read(len(MAGIC)) != MAGIC:
+            return
+        header_length = struct.unpack("<I", segment_file.read(4))[0]
+        try:
+            header = json.loads(segment_file.read(header_length))
+        except ValueError:
+            return
+        length = len(MAGIC) + 4 + header_length + sum(size for name, size in header["files"])
+        if offset + length > end:
+            return
+        yield offset, length, header
+        offset += length
+
+def _recover(segment_path:str):
+    '''Makes the segment and its index agree again after a crash: records that made it to disk without an index line get one, and a partly written record at the end is cut off.'''
+    index_path = _index_path(segment_path)
+    with open(index_path, "rb+") as index_file:
+        index = index_file.read()
+        if index and not index.endswith(b"\n"):
+            index_file.truncate(index.rfind(b"\n") + 1)
+        index_file.close()
+    entries = _read_index(segment_path)
+    indexed_end = max((offset + length for offset, length in entries.values()), default=0)
+    with open(segment_path, "r+b") as segment_file:
+        segment_file.seek(0, os.SEEK_END)
+        if segment_file.tell() == indexed_end:
+            return
+        good_end = indexed_end
+        with open(index_path, "a") as index_file:
+            for offset, length, header in _scan(segment_file, indexed_end):
+                index_file.write(f"{header['id']}\t{offset}\t{length}\n")
+                good_end = offset + length
+            index_file.close()
+        log.warning(f"Archive segment {segment_path} wasn't closed cleanly, recovered it up to byte {good_end}.")
+        segment_file.truncate(good_end)
+        segment_file.close()
+
+def _current_segment(archive_dir:str, max_bytes:int, max_age:dt.timedelta):
+    segments = _segments(archive_dir)
+    if segments:
+        segment_path = segments[-1]
+        _recover(segment_path) # Before deciding to roll, so a crash can't leave records behind without an index.
+        started = _segment_started(segment_path)
+        too_old = started is None or dt.datetime.now(tz=dt.timezone.utc) - started >= max_age
+        if not too_old and os.path.getsize(segment_path) < max_bytes:
+            return segment_path
+    return _new_segment(archive_dir)
+
+def _record(alert_dir:str, include_audio:bool):
+    '''Reads an alert directory into (header, list of file contents).'''
+    names = [name for name in METADATA_FILES if os.path.isfile(os.path.join(alert_dir, name))]
+    if include_audio:
+        names += sorted(name for name in os.listdir(alert_dir) if name.endswith(AUDIO_SUFFIX))
+    contents = []
+    for name in names:
+        with open(os.path.join(alert_dir, name), "rb") as file:
+            contents.append(file.read())
+            file.close()
+    alert_json = json.loads(contents[0]) if names and names[0] == "response.json" else {}
+    header = {
+        "id": str(alert_json.get("id", os.path.basename(os.path.normpath(alert_dir)))),
+        "hash": alert_json.get("hash"),
+        "archived": dt.datetime.now(tz=dt.timezone.utc).isoformat(timespec="seconds").replace("+00:00", "Z"),
+        "files": [[name, len(content)] for name, content in zip(names, contents)]
+    }
+    return header, contents
+
+def append(archive_dir:str, alert_dir:str, settings:dict):
+    '''Appends the alert in alert_dir to the archive and returns its ID. settings is the "archive" section of the config. alert_dir is left alone, removing it is up to the caller.'''
+    header, contents = _record(alert_dir, settings["audio"])
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    record = b"".join([MAGIC, struct.pack("<I", len(header_bytes)), header_bytes] + contents)
+    os.makedirs(archive_dir, exist_ok=True)
+    with _lock, open(os.path.join(archive_dir, ".lock"), "a") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX) # The pack tool may be appending from another process.
+        segment_path = _current_segment(archive_dir, int(settings["segment_max_mb"] * 1024 * 1024), dt.timedelta(days=settings["segment_max_days"]))
+        with open(segment_path, "ab") as segment_file:
+            offset = segment_file.tell()
+            segment_file.write(record)
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+            segment_file.close()
+        with open(_index_path(segment_path), "a") as index_file: # The index is only written once the record is safely on disk.
+            index_file.write(f"{header['id']}\t{offset}\t{len(record)}\n")
+            index_file.close()
+    log.debug(f"Archived alert {header['id']} to {segment_path} at byte {offset} ({len(record)} bytes).")
+    return header["id"]
+
+def locate(archive_dir:str, alert_id):
+    '''Returns (segment path, offset, length) of the newest record for alert_id, or None if it isn't archived.'''
+    alert_id = str(alert_id)
+    with _lock:
+        for segment_path in reversed(_segments(archive_dir)):
+            found = _read_index(segment_path).get(alert_id)
+            if found:
+                return (segment_path, *found)
+    return None
+
+def read(archive_dir:str, alert_id):
+    '''Returns (header, {file name: contents}) for an archived alert, or None if it isn't archived.'''
+    found = locate(archive_dir, alert_id)
+    if not found:
+        return None
+    segment_path, offset, length = found
+    with open(segment_path, "rb") as segment_file:
+        segment_file.seek(offset)
+        data = segment_file.read(length)
+        segment_file.close()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"Archive record for {alert_id} in {segment_path} is damaged.")
+    header_length = struct.unpack("<I", data[len(MAGIC):len(MAGIC) + 4])[0]
+    position = len(MAGIC) + 4 + header_length
+    header = json.loads(data[len(MAGIC) + 4:position])
+    files = {}
+    for name, size in header["files"]:
+        files[name] = data[position:position + size]
+        position += size
+    return header, files
+
+def alert_ids(archive_dir:str):
+    '''Returns the ID of every archived alert.'''
+    with _lock:
+        ids = set()
+        for segment_path in _segments(archive_dir):
+            ids.update(_read_index(segment_path))
+    return ids
+
+def extract(archive_dir:str, alert_id, destination:str):
+    '''Writes an archived alert back out as a directory in destination, like the ones in alerts_dir. Returns the directory, or None if it isn't archived.'''
+    found = read(archive_dir, alert_id)
+    if not found:
+        return None
+    header, files = found
+    alert_dir = os.path.join(destination, header["id"])
+    os.makedirs(alert_dir, exist_ok=True)
+    for name, content in files.items():
+        with open(os.path.join(alert_dir, name), "wb") as file:
+            file.write(content)
+            file.close()
+    return alert_dir
+
+def pack(archive_dir:str, settings:dict, keep:bool = False):
+    '''Appends every old-style alert directory in archive_dir to the segments, removing each directory once it's in (unless keep is set). Returns how many were packed.'''
+    packed = 0
+    for name in sorted(os.listdir(archive_dir)):
+        alert_dir = os.path.join(archive_dir, name)
+        if not os.path.isdir(alert_dir) or not os.path.isfile(os.path.join(alert_dir, "response.json")):
+            continue
+        append(archive_dir, alert_dir, settings)
+        if not keep:
+            shutil.rmtree(alert_dir)
+        packed += 1
+        if packed % 1000 == 0:
+            print(f"Packed {packed} alert(s)...")
+    return packed
+
+def main():
+    import configManager
+    parser = argparse.ArgumentParser(description="Pack old archive directories into segments, or list and extract archived alerts.")
+    parser.add_argument("--config", default="boiler.cfg", help="Path to boiler.cfg")
+    commands = parser.add_subparsers(dest="command", required=True)
+    pack_parser = commands.add_parser("pack", help="Move every alert directory in archive_dir into segments")
+    pack_parser.add_argument("--keep", action="store_true", help="Leave the directories in place after packing them")
+    commands.add_parser("list", help="Print the ID of every archived alert")
+    extract_parser = commands.add_parser("extract", help="Write archived alerts back out as directories")
+    extract_parser.add_argument("ids", nargs="+", help="Alert IDs")
+    extract_parser.add_argument("--to", default=".", help="Directory to write them to (default the current one)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    config = configManager.load(args.config)
+    archive_dir = config["archive_dir"]
+    if args.command == "pack":
+        packed = pack(archive_dir, config["archive"], keep=args.keep)
+        print(f"Packed {packed} alert(s) into {len(_segments(archive_dir))} segment(s) in {archive_dir}.")
+    elif args.command == "list":
+        for alert_id in sorted(alert_ids(archive_dir), key=lambda alert_id: (len(alert_id), alert_id)):
+            print(alert_id)
+    else:
+        missing = 0
+        for alert_id in args.ids:
+            alert_dir = extract(archive_dir, alert_id, args.to)
+            if alert_dir:
+                print(f"Extracted {alert_id} to {alert_dir}")
+            else:
+                print(f"{alert_id} isn't in the archive.")
+                missing += 1
+        return 1 if missing else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,199 @@
+## audioCache is a content-addressed store for alert audio. Every downloaded MP3 is filed under the SHA-256 of its contents along with its trimmed
+## version and the cut points that were used, and alert directories get hard links to those files instead of their own copies.
+## The same broadcast relayed by several stations (or an alert that gets re-stored) only gets downloaded and trimmed once.
+import hashlib, json, logging, os, shutil, threading, time, uuid
+
+log = logging.getLogger(__name__)
+
+SOURCE_FILENAME = "source-audio.mp3"
+TRIMMED_FILENAME = "eas-audio.mp3"
+CUTS_FILENAME = "cuts.json"
+INDEX_FILENAME = "index.json"
+
+_lock = threading.Lock()
+cache_dir = None # None means the cache is disabled.
+max_bytes = 0
+_index = None # {"urls": {url: hash}, "entries": {hash: {"size": bytes, "last_used": epoch}}}
+
+def configure(directory:str, max_mb:float):
+    '''Enables the cache in directory, capped at max_mb megabytes. A directory of None (or an empty string) disables it.'''
+    global cache_dir, max_bytes, _index
+    with _lock:
+        directory = directory or None
+        if directory != cache_dir:
+            cache_dir = directory
+            _index = None
+            if cache_dir:
+                os.makedirs(cache_dir, exist_ok=True)
+                log.info(f"Audio cache enabled in {cache_dir} ({max_mb} MB).")
+        max_bytes = int(max_mb * 1024 * 1024)
+
+def hash_file(path:str):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+        file.close()
+    return digest.hexdigest()
+
+def _entry_dir(directory:str, content_hash:str):
+    return os.path.join(directory, content_hash)
+
+def _temp_path(path:str):
+    '''A temporary name next to path that no other worker process or thread will pick, since several of them can be filing the same cache entry at once.'''
+    return f"{path}.{uuid.uuid4().hex}.tmp"
+
+def _link_or_copy(src:str, dst:str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def link_file(src:str, dst:str):
+    '''Hard links src to dst, replacing dst if it exists. Falls back to copying if hard links aren't possible (different filesystems, for example).'''
+    temp_path = _temp_path(dst)
+    try:
+        _link_or_copy(src, temp_path)
+        os.replace(temp_path, dst)
+    finally:
+        if os.path.lexists(temp_path): # os.replace() leaves it behind if src and dst were already the same file.
+            os.remove(temp_path)
+
+def _add_file(src:str, cached:str):
+    '''Files src into the cache as cached, unless it's already there (another worker may have filed the same audio a moment ago). Returns True if src was added.'''
+    if os.path.exists(cached):
+        return False
+    temp_path = _temp_path(cached)
+    try:
+        _link_or_copy(src, temp_path)
+        try:
+            os.link(temp_path, cached) # Unlike os.replace(), this fails if cached exists, so whoever gets there first wins.
+        except FileExistsError:
+            return False
+        return True
+    finally:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+
+## These run inside the audio worker processes, so they only touch the files of a single entry and never the index.
+
+def store_source(directory:str, path_source:str):
+    '''Files a freshly downloaded source MP3 into the cache and returns its hash. If the same audio is already cached, the alert's copy is swapped for a link to the cached one.'''
+    content_hash = hash_file(path_source)
+    entry_dir = _entry_dir(directory, content_hash)
+    os.makedirs(entry_dir, exist_ok=True)
+    cached_source = os.path.join(entry_dir, SOURCE_FILENAME)
+    if not _add_file(path_source, cached_source): # Already cached, that's a cache hit and not an error.
+        link_file(cached_source, path_source)
+    return content_hash
+
+def load_trimmed(directory:str, content_hash:str, detector:str, alert_directory:str):
+    '''Links the cached trimmed audio into alert_directory if it was made with the same detector. Returns the cut points, or None if there's nothing usable in the cache.'''
+    entry_dir = _entry_dir(directory, content_hash)
+    try:
+        with open(os.path.join(entry_dir, CUTS_FILENAME), "r") as cuts_file:
+            cuts = json.load(cuts_file)
+            cuts_file.close()
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return None
+    cached_trimmed = os.path.join(entry_dir, TRIMMED_FILENAME)
+    if cuts.get("detector") != detector or not os.path.exists(cached_trimmed):
+        return None
+    link_file(cached_trimmed, os.path.join(alert_directory, TRIMMED_FILENAME))
+    return cuts.get("cut_points")
+
+def store_trimmed(directory:str, content_hash:str, detector:str, alert_directory:str, cut_points:dict):
+    '''Files the trimmed audio that was just made in alert_directory into the cache, along with its cut points.'''
+    entry_dir = _entry_dir(directory, content_hash)
+    os.makedirs(entry_dir, exist_ok=True)
+    link_file(os.path.join(alert_directory, TRIMMED_FILENAME), os.path.join(entry_dir, TRIMMED_FILENAME))
+    temp_path = _temp_path(os.path.join(entry_dir, CUTS_FILENAME))
+    with open(temp_path, "w") as cuts_file:
+        json.dump({"detector": detector, "cut_points": cut_points}, cuts_file, indent=2)
+        cuts_file.close()
+    os.replace(temp_path, os.path.join(entry_dir, CUTS_FILENAME))
+
+## Everything below runs in the main process and owns the index.
+
+def _load_index():
+    global _index
+    if _index is not None:
+        return _index
+    _index = {"urls": {}, "entries": {}}
+    try:
+        with open(os.path.join(cache_dir, INDEX_FILENAME), "r") as index_file:
+            loaded = json.load(index_file)
+            index_file.close()
+        _index["urls"].update(loaded.get("urls", {}))
+        _index["entries"].update(loaded.get("entries", {}))
+    except FileNotFoundError:
+        pass
+    except:
+        log.warning(f"Audio cache index in {cache_dir} couldn't be read, starting a new one.", exc_info=True)
+    return _index
+
+def _save_index():
+    temp_path = os.path.join(cache_dir, f"{INDEX_FILENAME}.tmp")
+    with open(temp_path, "w") as index_file:
+        json.dump(_index, index_file)
+        index_file.close()
+    os.replace(temp_path, os.path.join(cache_dir, INDEX_FILENAME))
+
+def _entry_size(content_hash:str):
+    entry_dir = _entry_dir(cache_dir, content_hash)
+    try:
+        return sum(entry.stat().st_size for entry in os.scandir(entry_dir) if entry.is_file())
+    except FileNotFoundError:
+        return 0
+
+def lookup(url:str, trim:bool, detector:str, alert_directory:str):
+    '''Checks whether the audio at url has been processed before. On a hit, the cached files are linked into alert_directory and a result like audioWorker.process_audio() returns is given back; otherwise None.'''
+    if not cache_dir:
+        return None
+    with _lock:
+        index = _load_index()
+        content_hash = index["urls"].get(url)
+        if not content_hash:
+            return None
+        cached_source = os.path.join(_entry_dir(cache_dir, content_hash), SOURCE_FILENAME)
+        if not os.path.exists(cached_source): # Evicted, or removed by hand.
+            index["urls"].pop(url, None)
+            index["entries"].pop(content_hash, None)
+            return None
+        cut_points = None
+        if trim:
+            cut_points = load_trimmed(cache_dir, content_hash, detector, alert_directory)
+            if cut_points is None:
+                return None # We have the source, but it still needs trimming, so let the worker have it.
+        link_file(cached_source, os.path.join(alert_directory, SOURCE_FILENAME))
+        index["entries"].setdefault(content_hash, {})["last_used"] = time.time()
+        _save_index()
+    log.info(f"Using cached audio {content_hash[:12]} for {alert_directory}.")
+    return {"filename": TRIMMED_FILENAME if trim else SOURCE_FILENAME, "trimmed": trim, "cut_points": cut_points, "timings": {}, "hash": content_hash}
+
+def record(url:str, content_hash:str):
+    '''Remembers which content url resolved to, marks the entry as just used, and evicts the least recently used entries if the cache is over its size limit.'''
+    if not cache_dir or not content_hash:
+        return
+    with _lock:
+        index = _load_index()
+        index["urls"][url] = content_hash
+        index["entries"][content_hash] = {"size": _entry_size(content_hash), "last_used": time.time()}
+        _evict(index)
+        _save_index()
+
+def _evict(index:dict):
+    total = sum(entry.get("size", 0) for entry in index["entries"].values())
+    if total <= max_bytes:
+        return
+    for content_hash, entry in sorted(index["entries"].items(), key=lambda item: item[1].get("last_used", 0)):
+        if total <= max_bytes:
+            break
+        # Alert directories hold hard links to these files, so evicting an entry never breaks an alert that's still on the feed.
+        shutil.rmtree(_entry_dir(cache_dir, content_hash), ignore_errors=True)
+        total -= entry.get("size", 0)
+        del index["entries"][content_hash]
+        log.debug(f"Evicted {content_hash[:12]} from the audio cache.")
+    stale_urls = [url for url, content_hash in index["urls"].items() if content_hash not in index["entries"]]
+    for url in stale_urls:
+        del index["urls"][url]
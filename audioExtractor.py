@@ -1,8 +1,9 @@
-import requests, os, shutil, logging
+import requests, os, logging
 from pydub import AudioSegment
 import numpy as np
 import aubio
 import coloredlogs
+import metrics
 
 log = logging.getLogger(__name__)
 
@@ -25,9 +26,11 @@ def download_mp3(url:str, path:str):
     try:
         r = requests.get(url=url, headers=headers, timeout=10)
         if r.headers.get("Content-Type") == "audio/mpeg":
-            with open(path, "wb") as file:
+            temp_path = f"{path}.part" # path may be a hard link into the audio cache, so never write through it.
+            with open(temp_path, "wb") as file:
                 file.write(r.content)
                 file.close()
+            os.replace(temp_path, path)
             log.debug(f"Audio downloaded successfully.")
         else:
             raise AudioFormatError
@@ -41,72 +44,72 @@ def download_mp3(url:str, path:str):
         log.error(f"The requested URL did not resolve to a file with MPEG audio headers. ({url})", exc_info=False)
         raise AudioRequestError
 
-def convert_mp3_to_wav(path_mp3:str, path_wav:str):
-    '''Take a guess what this does.'''
-    log.debug(f"Converting '{path_mp3}' to '{path_wav}'.")
-    audio = AudioSegment.from_mp3(path_mp3)
-    audio.set_frame_rate(16000)
-    audio.export(path_wav, format="wav", parameters=["-ar", "16000"])
-    log.debug(f"Conversion successful.")
-
-def convert_wav_to_mp3(path_wav: str, path_mp3: str, bitrate="192k"):
-    '''No, seriously, take a guess what it does.'''
-    log.debug(f"Converting '{path_wav}' to '{path_mp3}'.")
-    audio = AudioSegment.from_wav(path_wav)
-    audio.export(path_mp3, format="mp3", bitrate=bitrate)
-    log.debug(f"Conversion successful.")
-
-def scan_attn(path_wav:str):
-    '''This is really bad, and if you think you can do it better, PLEASE DO!! I AM BEGGING YOU.
+SAMPLE_RATE = 16000 # Everything is analyzed (and re-encoded) at 16 kHz mono, this is permanent with this setup.
+
+def decode_mp3(path_mp3:str):
+    '''Decodes an MP3 file once into memory and returns it as a NumPy array of 16-bit mono samples at SAMPLE_RATE, along with the sample rate.'''
+    log.debug(f"Decoding '{path_mp3}'.")
+    audio = AudioSegment.from_file(path_mp3, format="mp3", codec="mp3") # Naming the codec skips an extra ffprobe pass.
+    audio = audio.set_frame_rate(SAMPLE_RATE).set_channels(1).set_sample_width(2)
+    samples = np.frombuffer(audio.raw_data, dtype=np.int16)
+    log.debug(f"Decoded {len(samples)} samples ({len(samples) / SAMPLE_RATE} seconds).")
+    return samples, SAMPLE_RATE
+
+def encode_mp3(samples:np.ndarray, samplerate:int, path_mp3:str, bitrate="192k"):
+    '''Encodes a buffer of 16-bit mono samples (or a slice of one) straight to MP3, no WAV file in between.'''
+    log.debug(f"Encoding {len(samples)} samples to '{path_mp3}'.")
+    audio = AudioSegment(data=np.ascontiguousarray(samples, dtype=np.int16).tobytes(), sample_width=2, frame_rate=samplerate, channels=1)
+    temp_path = f"{path_mp3}.part" # path_mp3 may be a hard link into the audio cache, so never write through it.
+    try:
+        audio.export(temp_path, format="mp3", bitrate=bitrate).close() # export() hands back the file it left open.
+        os.replace(temp_path, path_mp3)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    log.debug(f"Encoding successful.")
+
+def to_float(samples:np.ndarray):
+    '''Converts 16-bit samples to float32 in the range of -1.0 to 1.0, which is what the analysis functions expect.'''
+    return samples.astype(np.float32) / 32768.0
+
+def scan_attn_yin(samples:np.ndarray, samplerate:int = SAMPLE_RATE):
+    '''The original attention tone detector, kept around for comparison (set audio.attn_detector to "yin"). This is really bad, and if you think you can do it better, PLEASE DO!! I AM BEGGING YOU.
     
     This functions "scans" for an 853/960hz attention tone by using the aubio library to gather pitch via MIDI units... In testing, the ATTN tone was always 81 (not in Hz). If you ask me what unit, I have no idea.
     It's consistent. It works. But it's not how it should be done. But it works, so. YOLO!
     
+    samples is a float32 buffer (see to_float()), pitch is read from views of it so nothing gets copied or written to disk.
     Returns True if successful, and the cut_point in seconds.'''
-    ## Audio analysis is difficult, and for some reason, trying to gather frequencies is seemingly impossible unless you want them on a graph.
-    ## So I found some weird code on StackOverflow that doesn't exactly work as intended, but... it could work? So.
     win_s = 4096
     hop_s = 512 
     tone_min_freq = 77
     tone_max_freq = 83
     confirm_threshold = 80000 / hop_s # 5 seconds is 80,000 frames
-
-    samplerate = 16000 # this is permanent with this setup
-    s = aubio.source(path_wav, samplerate, hop_s)
     tolerance = 0.8
 
     pitch_o = aubio.pitch("yin", win_s, hop_s, samplerate)
     pitch_o.set_unit("midi")
     pitch_o.set_tolerance(tolerance)
 
-    pitches = []
-    confidences = []
-
-    total_frames = 0
-    i = 0
+    total_frames = len(samples)
     hit_frames = 0
     last_hit_frame = 0
     confirmed_hit = False
-    while True:
-        samples, read = s()
-        pitch = pitch_o(samples)[0]
+    last_block = np.zeros(hop_s, dtype=np.float32) # aubio always wants a full hop, so the end of the audio gets padded.
+    for frame in range(0, total_frames, hop_s):
+        block = samples[frame:frame + hop_s]
+        if len(block) < hop_s:
+            last_block[:len(block)] = block
+            block = last_block
+        pitch = pitch_o(block)[0]
         if tone_min_freq < pitch < tone_max_freq:
             hit_frames += 1
-            #print(f"hit {hit_frames}")
             if hit_frames > confirm_threshold:
-                log.debug(f"Confirmed tone at frame {total_frames}")
+                log.debug(f"Confirmed tone at frame {frame}")
                 confirmed_hit = True
-                last_hit_frame = total_frames
+                last_hit_frame = frame
         else:
-            if hit_frames > 0:
-                hit_frames = 0
-
-        pitches += [pitch]
-        confidence = pitch_o.get_confidence()
-        confidences += [confidence]
-        total_frames += read
-        i += 1
-        if read < hop_s: break
+            hit_frames = 0
 
     duration = total_frames / samplerate
     log.debug(f"Total frames was {total_frames}. Duration: {duration}")
@@ -117,63 +120,222 @@ def scan_attn(path_wav:str):
         log.warning(f"Did not detect an attention tone in this audio.")
     return confirmed_hit, cut_point
 
-def get_length(path_wav:str):
-    '''Feed it a path to a WAV file and you get the duration in seconds.'''
-    audio = AudioSegment.from_wav(path_wav)
-    length = len(audio) / 1000
-    log.debug(f"Got length of {path_wav}, it's {length} seconds.")
-    return length
+## Attention tone detection. The buffer is cut into overlapping frames (views, no copies) and the energy at each tone frequency is measured for
+## every frame at once with a bank of single-bin DFTs, which is the same thing a Goertzel filter computes. A frame counts as a tone if nearly all
+## of its energy sits on those frequencies.
+ATTN_FREQS = (853.0, 960.0) # Two-tone EAS attention signal
+NWS_FREQ = 1050.0 # NOAA Weather Radio alert tone
+TONE_FRAME = 512 # 32 ms at 16 kHz, enough resolution to tell 853 and 960 Hz apart
+TONE_HOP = 256
+TONE_THRESHOLD = 0.7 # Fraction of a frame's energy that has to be on the tone frequencies
+TONE_MIN_DURATION = 2.0 # Seconds. Real attention tones are 8-25 seconds, so anything shorter is a false positive.
+TONE_MAX_GAP = 0.15 # Seconds of dropout (MP3 artifacts, clipping) that are bridged over inside a tone
 
-def cut_tail(path_wav:str, path_new_wav:str, cut_point):
-    '''Trims off the trailing portion (in seconds) from the audio file.
-    
-    cut_point must be in seconds.'''
-    log.debug(f"Trimming tail of WAV file ({path_wav}) at {cut_point} seconds.")    
-    audio = AudioSegment.from_wav(path_wav)
-    trimmed_audio = audio[:cut_point * 1000]
-    trimmed_audio.export(path_new_wav, format="wav")
-    log.debug(f"Exported as {path_new_wav}.")
-
-def cut_lead(path_wav:str, path_new_wav:str, cut_point):
-    '''Trims off the leading portion (in seconds) from the audio file.
-    
-    cut_point must be in seconds.'''
-    log.debug(f"Trimming lead of WAV file ({path_wav}) at {cut_point} seconds.")
-    audio = AudioSegment.from_wav(path_wav)
-    trimmed_audio = audio[cut_point * 1000:]
-    trimmed_audio.export(path_new_wav, format="wav")
-    log.debug(f"Exported as {path_new_wav}.")
-
-def trim_headers(directory:str, target_file:str):
+def tone_ratios(samples:np.ndarray, samplerate:int, freqs):
+    '''Returns an array of shape (frames, len(freqs)) with the fraction of each frame's energy found at each frequency, and the start time of each frame in seconds.'''
+    if len(samples) < TONE_FRAME:
+        return np.zeros((0, len(freqs)), dtype=np.float32), np.zeros(0)
+    frames = np.lib.stride_tricks.sliding_window_view(samples, TONE_FRAME)[::TONE_HOP]
+    window = np.hanning(TONE_FRAME).astype(np.float32)
+    n = np.arange(TONE_FRAME)
+    bank = np.exp(-2j * np.pi * np.outer(n, np.asarray(freqs) / samplerate)) * window[:, None] # One column per frequency
+    spectrum = np.abs(frames @ bank) ** 2
+    energy = (frames ** 2) @ (window ** 2)
+    # Scaled so that a pure sine wave at one of the frequencies gives a ratio of 1.0
+    scale = 2 * np.sum(window ** 2) / np.sum(window) ** 2
+    ratios = spectrum * scale / np.maximum(energy, 1e-9)[:, None]
+    ratios[energy < 1e-6 * TONE_FRAME] = 0 # Silence doesn't count as anything.
+    starts = np.arange(len(frames)) * TONE_HOP / samplerate
+    return ratios, starts
+
+def _longest_run(hits:np.ndarray, max_gap:int):
+    '''Returns (first, last) frame index of the longest run of True values, bridging over gaps of up to max_gap frames, or None.'''
+    index = np.flatnonzero(hits)
+    if len(index) == 0:
+        return None
+    breaks = np.flatnonzero(np.diff(index) > max_gap + 1)
+    run_starts = np.concatenate(([index[0]], index[breaks + 1]))
+    run_ends = np.concatenate((index[breaks], [index[-1]]))
+    longest = np.argmax(run_ends - run_starts)
+    return int(run_starts[longest]), int(run_ends[longest])
+
+def detect_tones(samples:np.ndarray, samplerate:int = SAMPLE_RATE):
+    '''Looks for the 853/960 Hz EAS attention signal and the 1050 Hz NWS tone. samples is a float32 buffer (see to_float()).
+
+    Returns None if neither was found, otherwise a dict with which tone was found, where it starts and ends (in seconds), and a confidence from 0 to 1.'''
+    ratios, starts = tone_ratios(samples, samplerate, ATTN_FREQS + (NWS_FREQ,))
+    if len(ratios) == 0:
+        return None
+    dual = ratios[:, 0] + ratios[:, 1]
+    both_present = np.minimum(ratios[:, 0], ratios[:, 1]) > TONE_THRESHOLD / 4 # Both tones have to be there, not just one of them.
+    candidates = {
+        "ATTN": (dual > TONE_THRESHOLD) & both_present,
+        "NWS": ratios[:, 2] > TONE_THRESHOLD
+    }
+    scores = {"ATTN": dual, "NWS": ratios[:, 2]}
+    max_gap = int(TONE_MAX_GAP * samplerate / TONE_HOP)
+    found = None
+    for tone, hits in candidates.items():
+        run = _longest_run(hits, max_gap)
+        if not run:
+            continue
+        first, last = run
+        start = float(starts[first])
+        end = float(starts[last]) + TONE_FRAME / samplerate
+        if end - start < TONE_MIN_DURATION:
+            log.debug(f"Ignoring {tone} tone candidate at {start:.2f}-{end:.2f} seconds, too short.")
+            continue
+        confidence = float(np.clip(np.mean(scores[tone][first:last + 1]), 0, 1))
+        if not found or end - start > found["end"] - found["start"]:
+            found = {"tone": tone, "start": start, "end": end, "confidence": confidence}
+    return found
+
+def scan_attn(samples:np.ndarray, samplerate:int = SAMPLE_RATE, mode:str = "goertzel"):
+    '''Scans for an attention tone (853/960 Hz or the 1050 Hz NWS tone). mode can be "goertzel" (default) or "yin" for the original aubio based detector.
+
+    samples is a float32 buffer (see to_float()). Returns True if successful, and the cut_point in seconds.'''
+    if mode == "yin":
+        return scan_attn_yin(samples, samplerate)
+    found = detect_tones(samples, samplerate)
+    if not found:
+        log.warning(f"Did not detect an attention tone in this audio.")
+        return False, 0.0
+    log.info(f"Found {found['tone']} tone from {found['start']:.3f} to {found['end']:.3f} seconds (confidence {found['confidence']:.2f})!")
+    return True, found["end"]
+
+## SAME header/EOM detection. The AFSK signal is demodulated by mixing the buffer down at the mark and space frequencies and averaging over one bit,
+## which gives the mark and space envelopes for every sample at once. Anywhere those two account for most of the signal is an FSK burst, and the
+## burst is sliced into bits at the baud rate to read whether it's a header (ZCZC) or an EOM (NNNN).
+SAME_MARK = 2083.3
+SAME_SPACE = 1562.5
+SAME_BAUD = 520.83
+SAME_MIN_BURST = 0.25 # Seconds. The shortest burst is an EOM, 16 preamble bytes + NNNN, which is about 0.3 seconds.
+SAME_THRESHOLD = 0.5 # Fraction of the signal that has to be on the mark/space frequencies
+HEADER_SCAN_SECONDS = 20.0 # How far into the audio headers are looked for when there's no attention tone to go by
+EOM_SCAN_SECONDS = 10.0 # Only this much of the end of the audio is scanned for EOMs
+EOM_FALLBACK_SECONDS = 4.0 # Cut off if the EOMs can't be found
+
+def _moving_average(values:np.ndarray, width:int):
+    cumulative = np.cumsum(values, axis=0)
+    cumulative[width:] = cumulative[width:] - cumulative[:-width]
+    return cumulative / width
+
+def _decode_burst(discriminator:np.ndarray, samples_per_bit:float):
+    '''Slices a burst into bits and returns the text it decodes to. The bit clock phase is picked by whichever phase gives the clearest mark/space decisions, and byte alignment comes from trying all 8 bit offsets.'''
+    bit_count = int(np.ceil(len(discriminator) / samples_per_bit))
+    if bit_count < 16:
+        return ""
+    best_phase, best_opening = 0, -1
+    for phase in range(0, int(samples_per_bit), 2):
+        positions = (phase + np.arange(bit_count) * samples_per_bit).astype(int)
+        positions = positions[positions < len(discriminator)]
+        opening = np.mean(np.abs(discriminator[positions]))
+        if opening > best_opening:
+            best_phase, best_opening = phase, opening
+    positions = (best_phase + np.arange(bit_count) * samples_per_bit).astype(int)
+    bits = (discriminator[positions[positions < len(discriminator)]] > 0).astype(np.uint8)
+    texts = []
+    for offset in range(8):
+        usable = (len(bits) - offset) // 8 * 8
+        data = np.packbits(bits[offset:offset + usable], bitorder="little").tobytes() # SAME is sent least significant bit first
+        texts.append(data.decode("ascii", errors="replace"))
+    for text in texts:
+        if "ZCZC" in text or "NNNN" in text:
+            return text
+    return ""
+
+def scan_same(samples:np.ndarray, samplerate:int = SAMPLE_RATE, offset:float = 0.0):
+    '''Finds SAME FSK bursts in a float32 buffer (see to_float()). offset is added to every time returned, so a slice of the audio can be scanned.
+
+    Returns a list of bursts, each a dict with "kind" ("header", "eom" or "unknown"), and "start"/"end" in seconds.'''
+    samples_per_bit = samplerate / SAME_BAUD
+    width = int(round(samples_per_bit))
+    if len(samples) < width * 16:
+        return []
+    n = np.arange(len(samples))
+    mixers = np.exp(-2j * np.pi * np.outer(n, (SAME_MARK, SAME_SPACE)) / samplerate).astype(np.complex64)
+    envelopes = np.abs(_moving_average(samples[:, None] * mixers, width)) # Column 0 is mark, column 1 is space
+    power = _moving_average(samples ** 2, width)
+    fsk_ratio = 2 * np.sum(envelopes ** 2, axis=1) / np.maximum(power, 1e-9)
+    fsk_ratio[power < 1e-6] = 0
+    discriminator = envelopes[:, 0] - envelopes[:, 1]
+
+    in_burst = np.concatenate(([False], fsk_ratio > SAME_THRESHOLD, [False]))
+    edges = np.flatnonzero(np.diff(in_burst.astype(np.int8)))
+    bursts = []
+    for start, end in zip(edges[::2], edges[1::2]):
+        if (end - start) / samplerate < SAME_MIN_BURST:
+            continue
+        # The moving average lags by half a bit on each edge.
+        text = _decode_burst(discriminator[start + width // 2:end], samples_per_bit)
+        if "NNNN" in text:
+            kind = "eom"
+        elif "ZCZC" in text:
+            kind = "header"
+        else:
+            kind = "unknown"
+        burst = {"kind": kind, "start": float(offset + max(start - width // 2, 0) / samplerate), "end": float(offset + end / samplerate)}
+        log.debug(f"Found SAME {kind} burst from {burst['start']:.3f} to {burst['end']:.3f} seconds.")
+        bursts.append(burst)
+    return bursts
+
+def find_cut_points(samples:np.ndarray, samplerate:int = SAMPLE_RATE, detector:str = "goertzel"):
+    '''Works out where the message audio starts and ends, in seconds.
+
+    The start is the end of the attention tone, or the end of the last SAME header if that comes later (or if there's no tone at all). The end is the start of the first EOM, found by scanning only the tail of the audio, or 4 seconds before the end if no EOM could be found.
+    Returns a dict with the cut points and what they were based on.'''
+    audio = to_float(samples)
+    audio_length = len(samples) / samplerate
+    with metrics.stage("attn_scan"):
+        scanned_ATTN, scanned_ATTN_cut = scan_attn(audio, samplerate, mode=detector)
+    lead = scanned_ATTN_cut if scanned_ATTN else 0.0
+
+    header_region = audio[:int(min(lead if scanned_ATTN else HEADER_SCAN_SECONDS, audio_length) * samplerate)]
+    with metrics.stage("same_scan"):
+        headers = [burst for burst in scan_same(header_region, samplerate) if burst["kind"] == "header"]
+    headers_end = headers[-1]["end"] if headers else None
+    if headers_end and headers_end > lead:
+        lead = headers_end
+
+    eom_offset = max(audio_length - EOM_SCAN_SECONDS, lead)
+    with metrics.stage("same_scan"):
+        eoms = [burst for burst in scan_same(audio[int(eom_offset * samplerate):], samplerate, offset=eom_offset) if burst["kind"] == "eom"]
+    if eoms:
+        tail = eoms[0]["start"]
+        log.info(f"Found {len(eoms)} EOM burst(s), cutting at {tail:.3f} seconds.")
+    else:
+        tail = audio_length - EOM_FALLBACK_SECONDS
+        log.warning(f"Did not find an EOM, cutting the last {EOM_FALLBACK_SECONDS} seconds instead.")
+    return {
+        "lead": lead,
+        "tail": tail,
+        "attn_end": scanned_ATTN_cut if scanned_ATTN else None,
+        "headers_end": headers_end,
+        "eom_start": eoms[0]["start"] if eoms else None
+    }
+
+def trim_headers(directory:str, target_file:str, detector:str = "goertzel"):
     '''Complicated and kind of annoying logic to attempt to remove the attention tone and EOMs from an EAS_NET audio source. 
     
-    directory should be the path leading to the folder with the audio file, and target_file needs to be the path leading to the audio file, including the directory.'''
-    ## OH BOY!!!!
+    directory should be the path leading to the folder with the audio file, and target_file needs to be the path leading to the audio file, including the directory.
     
-    ## First, we'll convert the received MP3 audio file to a WAV so that we can analyze it with scipy.
-    path_temp_wav = os.path.join(directory, f"audio-temp.wav")
-    convert_mp3_to_wav(target_file, path_temp_wav) # Saves audio.mp3 to audio-temp.wav
-    scanned_ATTN, scanned_ATTN_cut = scan_attn(path_wav=path_temp_wav)
-    trimmed_target_file = path_temp_wav
-    if scanned_ATTN:
-        trimmed_target_file = path_temp_wav
-        cut_lead(path_wav=path_temp_wav,path_new_wav=trimmed_target_file,cut_point=scanned_ATTN_cut)
-    #scanned_EOM = scan_EOM(path_wav=path_temp_wav) # I'll do this later, if necessary. For now I'm just going to cut off the last 4 seconds of audio.
-    scanned_EOM = True
-    if scanned_EOM:
-        trimmed_target_file = path_temp_wav
-        audio_length = get_length(path_temp_wav)
-        cut_EOM_point = audio_length - 4 # subtract four seconds.
-        cut_tail(path_wav=path_temp_wav, path_new_wav=trimmed_target_file,cut_point=cut_EOM_point)
+    The MP3 is decoded exactly once, the cut points are found on the decoded buffer, and the trimmed slice of that buffer is encoded straight to eas-audio.mp3. No temporary files are written.
+    detector picks the attention tone detector, see scan_attn().
+    Returns the cut points (in seconds) that were used.'''
+    with metrics.stage("audio_decode"):
+        samples, samplerate = decode_mp3(target_file)
+    cut_points = find_cut_points(samples, samplerate, detector=detector)
+    lead, tail = cut_points["lead"], cut_points["tail"]
+    log.debug(f"Trimming audio to {lead} - {tail} seconds.")
+    trimmed = samples[int(lead * samplerate):max(int(tail * samplerate), 0)] # A view, not a copy.
     path_final_mp3 = os.path.join(directory, f"eas-audio.mp3")
-    convert_wav_to_mp3(path_wav=trimmed_target_file,path_mp3=path_final_mp3)
-    log.debug(f"Cleaning up temporary WAV file.")
-    os.remove(path=path_temp_wav)
+    with metrics.stage("audio_encode"):
+        encode_mp3(trimmed, samplerate, path_final_mp3)
+    return cut_points
 
 
 
 if __name__ == "__main__":
-    #scan_attn(path_wav="alerts/86240/audio-temp.wav")
     log.setLevel(logging.DEBUG)
     coloredlogs.install(level="DEBUG")
-    trim_headers(directory="alerts\\86240", target_file="alerts\\86240\\audio.mp3")
\ No newline at end of file
+    trim_headers(directory="alerts\\86240", target_file="alerts\\86240\\audio.mp3")
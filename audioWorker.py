@@ -0,0 +1,227 @@
+## audioWorker runs the audio side of storing an alert (downloading and trimming the MP3) in separate processes, so a bad MP3 can't stall the polling loop.
+## Every job gets a wall-clock timeout, and if trimming fails or takes too long the alert is published with the untrimmed source audio instead.
+import cProfile, logging, multiprocessing, os, threading, time, traceback
+from collections import deque
+import audioExtractor as ae
+import audioCache
+import metrics
+
+log = logging.getLogger(__name__)
+
+SOURCE_FILENAME = "source-audio.mp3"
+TRIMMED_FILENAME = "eas-audio.mp3"
+
+class AudioJobError(Exception):
+    '''Raised when an audio job failed before there was any source audio to fall back on.'''
+    pass
+
+## Pool state. Jobs run in their own process so they can be killed on timeout; a semaphore caps how many run at once and another caps how many
+## can be waiting for a slot.
+_lock = threading.Lock()
+_context = None
+_workers = 0
+_queue_size = 0
+_worker_slots = None
+_queue_slots = None
+_stats = {
+    "queued": 0, # Jobs waiting for a worker slot right now
+    "running": 0,
+    "completed": 0,
+    "failed": 0,
+    "timed_out": 0,
+    "passthrough": 0, # Jobs that ended up publishing the untrimmed source audio
+    "rejected": 0, # Jobs that didn't fit in the queue
+    "cache_hits": 0 # Jobs that were answered from the audio cache without running at all
+}
+_durations = deque(maxlen=200) # Wall-clock seconds of the most recent jobs, including time spent queued
+profile_dir = None # Set by profiler while a session is running, jobs write their cProfile stats there.
+
+def _get_context():
+    methods = multiprocessing.get_all_start_methods()
+    if "forkserver" in methods:
+        # Children are forked from a clean server process that already has numpy/pydub imported, instead of from our threaded process.
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["audioWorker"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+def configure(workers:int = 0, queue_size:int = 32):
+    '''Sizes the pool. workers of 0 (or less) means one per CPU core. Can be called again with new values, jobs that are already running aren't affected.'''
+    global _context, _workers, _queue_size, _worker_slots, _queue_slots
+    workers = workers if workers > 0 else (os.cpu_count() or 1)
+    queue_size = max(queue_size, 0)
+    with _lock:
+        if _context is None:
+            _context = _get_context()
+        if workers == _workers and queue_size == _queue_size:
+            return
+        log.info(f"Audio worker pool set to {workers} worker(s) with room for {queue_size} queued job(s).")
+        _workers = workers
+        _queue_size = queue_size
+        _worker_slots = threading.BoundedSemaphore(workers)
+        _queue_slots = threading.BoundedSemaphore(workers + queue_size)
+
+def stats():
+    '''Returns a snapshot of the pool: how many jobs are queued/running, totals for each outcome, and duration percentiles of recent jobs (in seconds).'''
+    with _lock:
+        snapshot = dict(_stats)
+        durations = sorted(_durations)
+        snapshot["workers"] = _workers
+        snapshot["queue_size"] = _queue_size
+    for name, percentile in (("p50", 0.50), ("p90", 0.90), ("p99", 0.99)):
+        snapshot[f"duration_{name}"] = durations[min(int(len(durations) * percentile), len(durations) - 1)] if durations else None
+    snapshot["duration_max"] = durations[-1] if durations else None
+    return snapshot
+
+def _count(name:str, amount:int = 1):
+    with _lock:
+        _stats[name] += amount
+
+def _job_main(conn, url:str, directory:str, trim:bool, detector:str, cache_dir:str, profile_dir:str = None):
+    '''Runs inside the worker process. Reports back through conn: ("downloaded", timings, content hash) once the source audio is on disk, then ("done", result, metrics) or ("error", message, traceback, metrics).
+    If profile_dir is set, the job is profiled and its stats are written there.'''
+    timings = {}
+    metrics.reset() # Only this job's metrics go back to the parent.
+    profile = None
+    if profile_dir:
+        profile = cProfile.Profile()
+        profile.enable()
+    try:
+        started = time.perf_counter()
+        path_source = os.path.join(directory, SOURCE_FILENAME)
+        ae.download_mp3(url=url, path=path_source)
+        content_hash = audioCache.store_source(cache_dir, path_source) if cache_dir else None
+        timings["download"] = time.perf_counter() - started
+        metrics.stage_seconds.observe(timings["download"], stage="audio_download")
+        conn.send(("downloaded", timings, content_hash))
+        cut_points = None
+        if trim:
+            if cache_dir:
+                cut_points = audioCache.load_trimmed(cache_dir, content_hash, detector, directory) # Same audio, different URL.
+            if cut_points is None:
+                started = time.perf_counter()
+                cut_points = ae.trim_headers(directory, path_source, detector=detector)
+                timings["trim"] = time.perf_counter() - started
+                metrics.stage_seconds.observe(timings["trim"], stage="audio_trim")
+                if cache_dir:
+                    audioCache.store_trimmed(cache_dir, content_hash, detector, directory, cut_points)
+        outcome = ("done", {"cut_points": cut_points, "timings": timings, "hash": content_hash})
+    except BaseException as e:
+        outcome = ("error", f"{type(e).__name__}: {str(e).splitlines()[0] if str(e) else ''}", traceback.format_exc())
+    try:
+        if profile: # Written before reporting back, the parent stops waiting on us once it has the outcome.
+            profile.disable()
+            profile.dump_stats(os.path.join(profile_dir, f"audio-{os.getpid()}-{time.monotonic_ns()}.prof"))
+        conn.send(outcome + (metrics.snapshot(),))
+    finally:
+        conn.close()
+
+def _run_inline(url:str, directory:str):
+    '''Used when the queue is full: only downloads the source audio in the calling thread so the alert can go out untrimmed.'''
+    path_source = os.path.join(directory, SOURCE_FILENAME)
+    ae.download_mp3(url=url, path=path_source)
+    content_hash = audioCache.store_source(audioCache.cache_dir, path_source) if audioCache.cache_dir else None
+    return {"filename": SOURCE_FILENAME, "trimmed": False, "cut_points": None, "timings": {}, "hash": content_hash}
+
+def process_audio(url:str, directory:str, trim:bool = True, detector:str = "goertzel", timeout:float = 60):
+    '''Downloads the alert audio at url into directory and (if trim is set) trims the headers off of it in a worker process.
+
+    Returns a dict with the filename that should be published ("eas-audio.mp3", or "source-audio.mp3" if trimming was skipped, failed or timed out), whether it was trimmed, the cut points and how long each step took.
+    Raises AudioJobError if not even the source audio could be downloaded.'''
+    if _context is None:
+        configure()
+    cached = audioCache.lookup(url, trim, detector, directory)
+    if cached:
+        _count("cache_hits")
+        return cached
+    queue_slots, worker_slots = _queue_slots, _worker_slots
+    if not queue_slots.acquire(blocking=False):
+        _count("rejected")
+        log.warning(f"Audio job queue is full ({_workers} running, {_queue_size} queued), publishing untrimmed audio for {directory}.")
+        try:
+            result = _run_inline(url, directory)
+        except Exception as e:
+            raise AudioJobError(str(e))
+        audioCache.record(url, result["hash"])
+        _count("passthrough")
+        return result
+
+    started = time.perf_counter()
+    _count("queued")
+    try:
+        worker_slots.acquire()
+        _count("queued", -1)
+        _count("running")
+        try:
+            result = _run_job(url, directory, trim, detector, timeout, started)
+            audioCache.record(url, result["hash"])
+            return result
+        finally:
+            _count("running", -1)
+            worker_slots.release()
+            elapsed = time.perf_counter() - started
+            metrics.stage_seconds.observe(elapsed, stage="audio_job")
+            with _lock:
+                _durations.append(elapsed)
+    finally:
+        queue_slots.release()
+
+def _run_job(url:str, directory:str, trim:bool, detector:str, timeout:float, started:float):
+    receiver, sender = _context.Pipe(duplex=False)
+    process = _context.Process(target=_job_main, args=(sender, url, directory, trim, detector, audioCache.cache_dir, profile_dir), daemon=True, name=f"audio-{os.path.basename(directory)}")
+    process.start()
+    sender.close()
+    downloaded = False
+    content_hash = None
+    timed_out = False
+    outcome = None
+    deadline = time.perf_counter() + timeout # Time spent waiting in the queue doesn't count against the job.
+    try:
+        while outcome is None:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0 or not receiver.poll(remaining):
+                timed_out = True
+                break
+            try:
+                message = receiver.recv()
+            except EOFError: # The worker died without telling us anything.
+                break
+            if message[0] == "downloaded":
+                downloaded = True
+                content_hash = message[2]
+            else:
+                outcome = message
+                metrics.merge(outcome[-1])
+    finally:
+        receiver.close()
+        if process.is_alive():
+            process.terminate()
+            process.join(2)
+            if process.is_alive():
+                process.kill()
+        process.join()
+
+    elapsed = time.perf_counter() - started
+    if outcome and outcome[0] == "done":
+        _count("completed")
+        result = outcome[1]
+        result["filename"] = TRIMMED_FILENAME if trim else SOURCE_FILENAME
+        result["trimmed"] = trim
+        log.info(f"Audio job for {directory} finished in {elapsed:.2f} seconds.")
+        return result
+
+    if outcome:
+        _count("failed")
+        log.error(f"Audio job for {directory} failed after {elapsed:.2f} seconds: {outcome[1]}")
+        log.debug(outcome[2])
+    elif timed_out:
+        _count("timed_out")
+        log.error(f"Audio job for {directory} timed out after {timeout} seconds and was killed.")
+    else:
+        _count("failed")
+        log.error(f"Audio worker for {directory} exited unexpectedly (exit code {process.exitcode}).")
+    if not downloaded:
+        raise AudioJobError(f"Couldn't download the audio for {directory}.")
+    _count("passthrough")
+    log.warning(f"Publishing the untrimmed source audio for {directory} instead.")
+    return {"filename": SOURCE_FILENAME, "trimmed": False, "cut_points": None, "timings": {}, "hash": content_hash}
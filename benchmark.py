@@ -0,0 +1,396 @@
+## benchmark times each stage of Boiler on its own, offline, so changes can be checked for speedups and regressions.
+## CAR entries are generated in the same shape sendTest.get_details() builds (plus a callsign, like the real CAR feed has), filters are generated
+## to match, and the audio stages run on a set of fixture MP3s that are synthesized on the first run (SAME headers, attention tone, "voice", EOMs).
+##
+##   python3 benchmark.py                                  Run everything and write benchmark-results.json
+##   python3 benchmark.py --scales 10 100 --stages filters Only some of it
+##   python3 benchmark.py --compare old-results.json       Also compare against an earlier run, exits with 1 if anything got slower than --threshold
+import argparse, json, logging, os, platform, random, shutil, subprocess, sys, tempfile, time
+import datetime as dt
+import numpy as np
+
+SCALES = (10, 100, 1000, 10000)
+STAGES = ("filters", "trim_string", "cap_xml", "store_alert", "update_feed", "audio")
+FIXTURES_DIR = "benchmark-fixtures"
+OUTPUT_PATH = "benchmark-results.json"
+SEED = 8675309
+
+## Generated inputs
+
+def make_entries(count:int, seed:int = SEED, minutes:int = 60):
+    '''Returns count CAR entries with random (but repeatable) events, originators, areas and prefixed translations.'''
+    import easTables as eas
+    rng = random.Random(seed)
+    tables = eas.tables()
+    events = sorted(tables["EVENTS"])
+    originators = sorted(tables["ORGS"])
+    counties = sorted(tables["SAME"])
+    now = dt.datetime.now(tz=dt.timezone.utc)
+    entries = []
+    for number in range(count):
+        event = rng.choice(events)
+        originator = rng.choice(originators)
+        fips = [f"{rng.randrange(10)}{rng.choice(counties)}" for _ in range(rng.randint(1, 5))]
+        callsign = rng.choice(["KWXR/NWS", "WABC/FM ", "EASYCAP ", "KCCL/TV "])
+        end = now + dt.timedelta(minutes=minutes)
+        areas = "; ".join(eas.area_name(code) for code in fips)
+        translation = (f"{eas.originator_name(originator, '')}{eas.event_name(event)} for the following counties/areas: {areas}; "
+                       f"at {rng.randint(1, 12)}:{rng.randint(0, 59):02d} PM on OCT 18, 2026 Effective until {rng.randint(1, 12)}:{rng.randint(0, 59):02d} PM. "
+                       f"Message from {callsign.rstrip()}. " + "Take protective action now. " * rng.randint(1, 8))
+        entries.append({
+            "id": f"bench-{number}",
+            "hash": f"bench-{number}-{seed}",
+            "type": event,
+            "originator": originator,
+            "callsign": callsign,
+            "fipsCodes": fips,
+            "startTimeEpoch": now.timestamp(),
+            "startTime": now.isoformat(timespec='seconds').replace("+00:00", ""),
+            "endTimeEpoch": end.timestamp(),
+            "endTime": end.isoformat(timespec='seconds').replace("+00:00", ""),
+            "audioUrl": None,
+            "translation": translation
+        })
+    return entries
+
+def make_filters(count:int, seed:int = SEED):
+    '''Returns count filters in the filters.cfg format. Most of them are narrow blocks, and the last one allows everything, like a typical setup.'''
+    import easTables as eas
+    rng = random.Random(seed + 1)
+    tables = eas.tables()
+    events = sorted(tables["EVENTS"])
+    originators = sorted(tables["ORGS"])
+    counties = sorted(tables["SAME"])
+    filters = {}
+    for number in range(count - 1):
+        rules = {"allow": rng.random() < 0.3}
+        if rng.random() < 0.6:
+            rules["events"] = rng.sample(events, rng.randint(1, 4))
+        if rng.random() < 0.4:
+            rules["originators"] = rng.sample(originators, rng.randint(1, 2))
+        if rng.random() < 0.5 or len(rules) == 1:
+            rules["fips"] = [f"{rng.randrange(10)}{rng.choice(counties)}" for _ in range(rng.randint(1, 6))]
+        if rng.random() < 0.1:
+            rules["station_ids"] = ["KWXR/NWS"]
+        filters[f"FILTER {number}"] = rules
+    filters["ALLOW ANY ALERTS"] = {"events": None, "originators": None, "fips": None, "station_ids": None, "allow": True}
+    return filters
+
+def bench_config(alerts_dir:str):
+    import configManager
+    cfg = configManager.validate({})
+    cfg["alerts_dir"] = alerts_dir
+    cfg["archive_dir"] = os.path.join(alerts_dir, "archive")
+    cfg["web"]["root_url"] = "http://127.0.0.1:8080"
+    cfg["index"]["path"] = os.path.join(os.path.dirname(alerts_dir), "alerts.db") # In the temporary workdir, never the real index.
+    return configManager.freeze(cfg)
+
+## Fixture audio
+
+def _afsk(text:str, rate:int):
+    '''SAME AFSK for text, with the 16 byte preamble.'''
+    baud, mark, space = 520.83, 2083.3, 1562.5
+    data = bytes([0xAB] * 16) + text.encode()
+    bits = np.array([(byte >> shift) & 1 for byte in data for shift in range(8)])
+    sample_bits = np.minimum((np.arange(int(round(len(bits) * rate / baud))) * baud / rate).astype(int), len(bits) - 1)
+    frequency = np.where(bits[sample_bits] == 1, mark, space)
+    return 0.5 * np.sin(np.cumsum(2 * np.pi * frequency / rate))
+
+def _voice(seconds:float, rate:int, seed:int):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * rate)) / rate
+    envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 3 * t) ** 2
+    harmonics = sum(np.sin(2 * np.pi * f * t + rng.random() * 6) * a for f, a in ((180, .3), (360, .2), (540, .1), (720, .05)))
+    return 0.4 * envelope * harmonics + 0.02 * rng.standard_normal(len(t))
+
+def _silence(seconds:float, rate:int):
+    return np.zeros(int(seconds * rate))
+
+def synth_alert(rate:int, attn:str = "two-tone", attn_seconds:float = 8, voice_seconds:float = 15, header:str = "ZCZC-WXR-TOR-040001+0030-2911234-KWXR/NWS-", seed:int = 0):
+    '''Builds the audio of a complete EAS message: 3 headers, attention tone ("two-tone", "nws" or None), a voice-ish message and 3 EOMs.'''
+    parts = [_silence(0.5, rate)]
+    for _ in range(3):
+        parts += [_afsk(header, rate), _silence(1, rate)]
+    t = np.arange(int(attn_seconds * rate)) / rate
+    if attn == "two-tone":
+        parts += [0.25 * (np.sin(2 * np.pi * 853 * t) + np.sin(2 * np.pi * 960 * t)), _silence(1, rate)]
+    elif attn == "nws":
+        parts += [0.4 * np.sin(2 * np.pi * 1050 * t), _silence(1, rate)]
+    parts.append(_voice(voice_seconds, rate, seed))
+    for _ in range(3):
+        parts += [_silence(1, rate), _afsk("NNNN", rate)]
+    parts.append(_silence(0.5, rate))
+    return (np.concatenate(parts) * 32767 * 0.9).astype(np.int16)
+
+FIXTURES = {
+    "two-tone-short": {"attn": "two-tone", "attn_seconds": 8, "voice_seconds": 15},
+    "nws-short": {"attn": "nws", "attn_seconds": 8, "voice_seconds": 15},
+    "no-attn": {"attn": None, "attn_seconds": 0, "voice_seconds": 20},
+    "two-tone-long": {"attn": "two-tone", "attn_seconds": 8, "voice_seconds": 120}
+}
+
+def make_fixtures(directory:str = FIXTURES_DIR):
+    '''Writes the fixture MP3s to directory if they aren't there yet and returns {name: path}. Any other MP3s dropped in the directory (real recordings, for example) are included too.'''
+    import audioExtractor as ae
+    os.makedirs(directory, exist_ok=True)
+    for number, (name, recipe) in enumerate(FIXTURES.items()):
+        path = os.path.join(directory, f"{name}.mp3")
+        if not os.path.exists(path):
+            print(f"Generating fixture {path}...")
+            ae.encode_mp3(synth_alert(ae.SAMPLE_RATE, seed=number, **recipe), ae.SAMPLE_RATE, path, bitrate="64k")
+    return {os.path.splitext(name)[0]: os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.lower().endswith(".mp3")}
+
+## Timing
+
+def timed(function, repeats:int, setup = None):
+    '''Runs function repeats times (calling setup before each run, outside of the timing) and returns the list of durations in seconds.
+    Without a setup, function is also run once beforehand so first-call costs (regex compiling, imports) don't end up in the results.'''
+    durations = []
+    if not setup:
+        function()
+    for _ in range(repeats):
+        argument = setup() if setup else None
+        started = time.perf_counter()
+        function(argument) if setup else function()
+        durations.append(time.perf_counter() - started)
+    return durations
+
+def record(results:list, stage:str, scale, items:int, durations:list):
+    best = min(durations)
+    results.append({
+        "stage": stage,
+        "scale": scale,
+        "items": items,
+        "repeats": len(durations),
+        "best_s": best,
+        "mean_s": sum(durations) / len(durations),
+        "per_item_us": best / items * 1e6 if items else None
+    })
+    print(f"  {stage:<28}{str(scale):>16}{best * 1000:>12.3f} ms{(best / items * 1e6 if items else 0):>12.2f} us/item")
+
+def bench_filters(results:list, scale:int, repeats:int, workdir:str):
+    import filterEngine as fe
+    entries = make_entries(scale)
+    path = os.path.join(workdir, "filters.cfg")
+    with open(path, "w") as filter_file:
+        json.dump(make_filters(scale), filter_file)
+        filter_file.close()
+    fe.watched = False
+    def compile_filters():
+        fe._loaded_stamp = None
+        fe.load_filters(path)
+    record(results, "filters.compile", scale, scale, timed(compile_filters, repeats))
+    record(results, "filters.check_batch", scale, scale, timed(lambda: fe.check_batch(entries, path), repeats))
+
+def bench_trim_string(results:list, scale:int, repeats:int, workdir:str):
+    import alertProcessor as ap
+    texts = [entry["translation"] for entry in make_entries(scale)]
+    record(results, "trim_string", scale, scale, timed(lambda: [ap.trim_string(text) for text in texts], repeats))
+
+def _cap_etree(alert_hash:str, event:str, event_name:str, effective:str, expires:str, description:str, originator:str, audio_url:str = None, fips_codes = ()):
+    '''How store_alert() built alert.xml with ElementTree before capSerializer. Kept as the reference capSerializer has to match byte for byte.'''
+    import xml.etree.ElementTree as ET
+    xml_alert = ET.Element("alert", {"xmlns": "urn:oasis:names:tc:emergency:cap:1.2"})
+    for tag, text in (("identifier", f"Boiler-{alert_hash}"), ("sender", "BOILER"), ("sent", effective + "-00:00"), ("status", "Actual"), ("msgType", "Alert"),
+                      ("source", "BOILER-CAP"), ("scope", "Public"), ("addresses", "0"), ("code", "IPAWSv1.0")):
+        ET.SubElement(xml_alert, tag).text = text
+    xml_info = ET.SubElement(xml_alert, "info")
+    for tag, text in (("language", "en-US"), ("category", "Safety"), ("event", event_name), ("urgency", "Immediate"), ("severity", "Severe"), ("certainty", "Observed")):
+        ET.SubElement(xml_info, tag).text = text
+    xml_eventCode = ET.SubElement(xml_info, "eventCode")
+    ET.SubElement(xml_eventCode, "valueName").text = "SAME"
+    ET.SubElement(xml_eventCode, "value").text = event
+    for tag, text in (("effective", effective + "-00:00"), ("expires", expires + "-00:00"), ("senderName", "BOILER BY CABLE CONTRIBUTES TO LIFE"),
+                      ("headline", f"{event_name} via Boiler"), ("description", description)):
+        ET.SubElement(xml_info, tag).text = text
+    for name, value in (("EAS-ORG", originator), ("timezone", "UTC"), ("BLOCKCHANNEL", "CMAS")):
+        param = ET.SubElement(xml_info, "parameter")
+        ET.SubElement(param, "valueName").text = name
+        ET.SubElement(param, "value").text = value
+    if audio_url:
+        xml_resource = ET.SubElement(xml_info, "resource")
+        ET.SubElement(xml_resource, "resourceDesc").text = "EAS Broadcast Content"
+        ET.SubElement(xml_resource, "mimeType").text = "audio/x-ipaws-audio-mp3"
+        ET.SubElement(xml_resource, "uri").text = audio_url
+    xml_area = ET.SubElement(xml_info, "area")
+    for fips in fips_codes:
+        xml_geocode = ET.SubElement(xml_area, "geocode")
+        ET.SubElement(xml_geocode, "valueName").text = "SAME"
+        ET.SubElement(xml_geocode, "value").text = fips
+    ET.indent(ET.ElementTree(xml_alert), space="  ", level=0)
+    return ET.tostring(xml_alert, encoding="utf-8", xml_declaration=True)
+
+def bench_cap_xml(results:list, scale:int, repeats:int, workdir:str):
+    import capSerializer as cap
+    import easTables as eas
+    documents = []
+    for number, entry in enumerate(make_entries(scale)):
+        description = entry["translation"]
+        if number % 4 == 1:
+            description += " Stay <indoors> & away from windows." # Has to be escaped.
+        elif number % 4 == 2:
+            description = "" # Closed as <description />.
+        documents.append({
+            "alert_hash": entry["hash"],
+            "event": entry["type"],
+            "event_name": eas.event_name(entry["type"]),
+            "effective": entry["startTime"],
+            "expires": entry["endTime"],
+            "description": description,
+            "originator": entry["originator"],
+            "audio_url": f"http://127.0.0.1:9090/alerts/{entry['id']}/audio.mp3" if number % 2 else None,
+            "fips_codes": entry["fipsCodes"] if number % 8 != 3 else [] # Closed as <area />.
+        })
+    for fields in documents:
+        if cap.serialize(**fields) != _cap_etree(**fields):
+            raise AssertionError(f"capSerializer output differs from ElementTree for {fields['alert_hash']}.")
+    record(results, "cap_xml.etree", scale, scale, timed(lambda: [_cap_etree(**fields) for fields in documents], repeats))
+    record(results, "cap_xml.template", scale, scale, timed(lambda: [cap.serialize(**fields) for fields in documents], repeats))
+
+def _store(entries:list, config):
+    import alertProcessor as ap
+    for entry in entries:
+        ap.store_alert(entry=dict(entry), config=config)
+
+def _fresh_alerts_dir(workdir:str):
+    alerts_dir = os.path.join(workdir, "alerts")
+    shutil.rmtree(alerts_dir, ignore_errors=True)
+    os.makedirs(alerts_dir)
+    return alerts_dir
+
+def bench_store_alert(results:list, scale:int, repeats:int, workdir:str):
+    entries = make_entries(scale)
+    config = bench_config(os.path.join(workdir, "alerts"))
+    record(results, "store_alert", scale, scale, timed(lambda _: _store(entries, config), repeats, setup=lambda: _fresh_alerts_dir(workdir)))
+
+def bench_update_feed(results:list, scale:int, repeats:int, workdir:str):
+    import feedManagement as fm
+    alerts_dir = _fresh_alerts_dir(workdir)
+    config = bench_config(alerts_dir)
+    _store(make_entries(scale), config)
+    def cold():
+        fm._entry_cache.clear()
+        fm.published.update({"entries": None, "feed_url": None, "updated": None})
+    record(results, "update_feed.cold", scale, scale, timed(lambda _: fm.update_feed(config), repeats, setup=cold))
+    record(results, "update_feed.unchanged", scale, scale, timed(lambda: fm.update_feed(config), repeats))
+    extra = iter(make_entries(repeats, seed=SEED + 2))
+    def one_new():
+        entry = next(extra)
+        entry["id"] = f"{entry['id']}-new"
+        _store([entry], config)
+    record(results, "update_feed.one_new", scale, scale, timed(lambda _: fm.update_feed(config), repeats, setup=one_new))
+
+def bench_audio(results:list, repeats:int, workdir:str, fixtures_dir:str):
+    '''Times the audio stages on every fixture. Returns the cut points found in each one, so a speedup that changes the output doesn't go unnoticed.'''
+    import audioExtractor as ae
+    cut_points = {}
+    for name, path in make_fixtures(fixtures_dir).items():
+        samples, rate = ae.decode_mp3(path)
+        audio = ae.to_float(samples)
+        seconds = len(samples) / rate
+        cut_points[name] = ae.find_cut_points(samples, rate)
+        print(f"  fixture {name} ({seconds:.1f} seconds), cut at {cut_points[name]['lead']:.3f} - {cut_points[name]['tail']:.3f}")
+        record(results, "audio.decode_mp3", name, 1, timed(lambda: ae.decode_mp3(path), repeats))
+        record(results, "audio.scan_attn.goertzel", name, 1, timed(lambda: ae.scan_attn(audio, rate, mode="goertzel"), repeats))
+        record(results, "audio.scan_attn.yin", name, 1, timed(lambda: ae.scan_attn(audio, rate, mode="yin"), repeats))
+        record(results, "audio.scan_same", name, 1, timed(lambda: ae.scan_same(audio, rate), repeats))
+        record(results, "audio.find_cut_points", name, 1, timed(lambda: ae.find_cut_points(samples, rate), repeats))
+        directory = os.path.join(workdir, "audio")
+        os.makedirs(directory, exist_ok=True)
+        record(results, "audio.trim_headers", name, 1, timed(lambda: ae.trim_headers(directory, path), repeats))
+    return cut_points
+
+## Results
+
+def _file_stamp(path:str):
+    '''Size and modification time of an SQLite database and its WAL, to tell whether anything wrote to it.'''
+    stamps = []
+    for name in (path, f"{path}-wal"):
+        try:
+            stat = os.stat(name)
+            stamps.append((stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            stamps.append(None)
+    return stamps
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results:list, baseline_path:str, threshold:float):
+    '''Prints how each result changed against an earlier results file. Returns True if anything got slower than threshold (a ratio).'''
+    with open(baseline_path, "r") as baseline_file:
+        baseline = json.load(baseline_file)
+        baseline_file.close()
+    before = {(result["stage"], str(result["scale"])): result for result in baseline.get("results", [])}
+    regressed = False
+    print(f"\nCompared to {baseline_path} ({baseline.get('commit') or 'unknown commit'}):")
+    for result in results:
+        old = before.get((result["stage"], str(result["scale"])))
+        if not old or not old["best_s"]:
+            continue
+        ratio = result["best_s"] / old["best_s"]
+        flag = ""
+        if ratio > threshold:
+            flag = "  SLOWER"
+            regressed = True
+        elif ratio < 1 / threshold:
+            flag = "  faster"
+        print(f"  {result['stage']:<28}{str(result['scale']):>16}{old['best_s'] * 1000:>12.3f} ms ->{result['best_s'] * 1000:>10.3f} ms  x{ratio:.2f}{flag}")
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description="Time each stage of Boiler at several scales.")
+    parser.add_argument("--scales", type=int, nargs="+", default=list(SCALES), help=f"Number of alerts (and filters) to run each stage with (default {' '.join(map(str, SCALES))})")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES), help="Stages to run (default all)")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs of each measurement, the best one is reported (default 3)")
+    parser.add_argument("--fixtures", default=FIXTURES_DIR, help=f"Directory of fixture MP3s, generated if missing (default {FIXTURES_DIR})")
+    parser.add_argument("--output", default=OUTPUT_PATH, help=f"Where to write the results (default {OUTPUT_PATH})")
+    parser.add_argument("--compare", default=None, help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2, help="With --compare, how much slower (as a ratio) counts as a regression (default 1.2)")
+    args = parser.parse_args()
+
+    import configManager
+    logging.disable(logging.CRITICAL) # Boiler logs a line or more per alert, which would end up being most of what gets measured.
+    results = []
+    cut_points = None
+    workdir = tempfile.mkdtemp(prefix="boiler-bench-")
+    real_index = configManager.validate({})["index"]["path"]
+    real_index_stamp = _file_stamp(real_index)
+    try:
+        for stage in args.stages:
+            print(f"{stage}:")
+            if stage == "audio":
+                cut_points = bench_audio(results, args.repeats, workdir, args.fixtures)
+                continue
+            for scale in args.scales:
+                globals()[f"bench_{stage}"](results, scale, args.repeats, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if _file_stamp(real_index) != real_index_stamp:
+        raise AssertionError(f"The benchmark wrote to the real alert index ({real_index}), it should only ever touch its temporary workdir.")
+
+    output = {
+        "commit": git_commit(),
+        "time": dt.datetime.now(tz=dt.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "cpus": os.cpu_count(),
+        "scales": args.scales,
+        "repeats": args.repeats,
+        "results": results,
+        "cut_points": cut_points
+    }
+    with open(args.output, "w") as output_file:
+        json.dump(output, output_file, indent=2)
+        output_file.close()
+    print(f"\nWrote {len(results)} result(s) to {args.output}")
+    if args.compare and compare(results, args.compare, args.threshold):
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
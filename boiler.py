@@ -1,11 +1,20 @@
 ## BOILER: CAR to CAP Bridge by CABLE CONTRIBUTES TO LIFE
-import time, json, logging, os, coloredlogs
+import time, logging, os, coloredlogs
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from logging.handlers import RotatingFileHandler
 import alertProcessor as ap
 import feedManagement as fm
+import filterEngine as fe
+import alertRegistry as registry
+import audioWorker as aw
+import audioCache
+import configManager
+import metrics
+import profiler
+from pollScheduler import PollScheduler, POLL, EXPIRY
 import datetime as dt
 
-def setup_logger(log_filename: str = None, log_level=logging.DEBUG):
+def setup_logger(log_filename: str = None, log_level=logging.DEBUG, root_script: bool = __name__ == "__main__"):
     log_name = "Boiler"
     if not log_filename:
         log_dir = "logs"
@@ -14,7 +23,7 @@ def setup_logger(log_filename: str = None, log_level=logging.DEBUG):
 
     logger = logging.getLogger(log_name)
 
-    if __name__ == "__main__":
+    if root_script:
         logger.setLevel(log_level)
         coloredlogs.install(log_level)
 
@@ -37,83 +46,139 @@ log = setup_logger()
 config = None
 
 def load_config():
-    '''Reloads the config file on startup and at the start of each main loop. Additionally, it will also correct any malformed JSON and reset config objects to default values if objects are missing or incorrect.'''
+    '''Loads the config file through configManager, which also corrects any malformed JSON and resets config objects to default values if objects are missing or incorrect.
+    After startup the config is only re-read when configManager sees the file change.'''
     global config
-    log.info("Reloading configuration file.")
-    try:
-        with open(f"boiler.cfg", "r") as cfg_file: # Yeah, sorry, this means you need to run this script in its working directory.
-            cfg = json.load(cfg_file)
-            cfg_file.close()
-    except FileNotFoundError:
-        log.error(f"'boiler.cfg' not found in working directory! Config will be re-written and set to default values.")
-        cfg = {}
-    except json.decoder.JSONDecodeError:
-        log.error(f"'boiler.cfg' was not properly formatted as JSON! Config will be re-written and reset.")
-        cfg = {}
-    except: 
-        log.error(f"Something unexpected happened while trying to load the config file. You can find out more in the traceback below!", exc_info=True)
+    log.info("Loading configuration file.")
+    config = configManager.load(write_defaults=True)
+
+def filter_entries(feed_CAR:list):
+    '''Filter stage of the ingest pipeline. Walks every entry returned by the poll that is new or changed since the last poll, and returns only the ones that are unexpired, allowed by the filters, and not already stored.'''
+    changed = registry.diff(feed_CAR, filter_generation=fe.generation)
+    log.debug(f"{len(changed)} of {len(feed_CAR)} alert(s) on CAR are new or changed since the last poll.")
+    unexpired = []
+    for entry in changed:
+        log.debug(f"Alert received from CAR: {entry}")
+        log.info(f"Found alert on CAR: {entry.get('type')}")
+        timestamp = entry.get("endTime")
+        expired = fm.check_expiry(timestamp=timestamp)
+        if not expired:
+            unexpired.append(entry)
+        else:
+            log.info(f"Alert is expired and won't be processed.")
+            metrics.alerts_filtered.inc(reason="expired")
+    to_store = []
+    for entry, filter_match in zip(unexpired, ap.check_filters_batch(unexpired)):
+        if filter_match:
+            if not ap.check_if_stored(entry=entry, config=config):
+                to_store.append(entry)
+            else:
+                log.debug(f"We have already downloaded this alert.")
+                metrics.alerts_filtered.inc(reason="stored")
+        else:
+            metrics.alerts_filtered.inc(reason="blocked")
+    metrics.alerts_seen.inc(len(changed))
+    return to_store
+
+def ingest_alert(entry:dict, received:float = None):
+    '''Store stage of the ingest pipeline, ran on a worker thread. Downloads/trims the audio and writes the CAP XML for a single alert, then publishes it to the feed right away instead of waiting on the rest of the batch.
     
-    # We'll load the current config values as a new config, if they exist, and if not, the values will be set back to the default.
-    new_cfg = {
-        "poll_url": str(cfg.get("poll_url", "https://alerts.globaleas.org/api/v1/alerts/active")),
-        "alerts_dir": str(cfg.get("alerts_dir", "alerts")),
-        "archive_dir": str(cfg.get("archive_dir", "archive")),
-        "web": {
-            "flask": {
-                "enabled": bool(cfg.get("web", {}).get("flask", {}).get("enabled", True)),
-                "host_address": str(cfg.get("web", {}).get("flask", {}).get("host_address", "127.0.0.1")),
-                "host_port": int(cfg.get("web", {}).get("flask", {}).get("host_port", 8080))
-            },
-            "root_url": str(cfg.get("web", {}).get("root_url", "https://your-domain.or.ip-address:port/boiler")),
-            "alerts_suffix": str(cfg.get("web", {}).get("alerts_suffix", "/IPAWSOPEN_EAS_SERVICE/rest/alerts")),
-            "feed_suffix": str(cfg.get("web", {}).get("feed_suffix", "/IPAWSOPEN_EAS_SERVICE/rest/feed")),
-            "update_suffix": str(cfg.get("web", {}).get("update_suffix", "/IPAWSOPEN_EAS_SERVICE/rest/update"))
-        },
-        "audio": {
-            "store_local": bool(cfg.get("audio", {}).get("store_local", True)),
-            "trim_headers": bool(cfg.get("audio", {}).get("trim_headers", True))
-        },
-        "delete_on_expire": bool(cfg.get("delete_on_expire", True)),
-        "trim_encoder_prefix": bool(cfg.get("trim_encoder_prefix", True))
-    }
-    if new_cfg != cfg: # This condition would only ever be met if a key was reset to the default value.
-        difference = new_cfg.keys() - cfg.keys()
-        log.warning(f"Some config items were missing or invalid and reset to the default values: {difference}")
-        log.info("Overwriting config file 'boiler.cfg'")
-        with open(f"boiler.cfg", "w") as cfg_file:
-            json.dump(obj=new_cfg, fp=cfg_file, indent=2)
-            cfg_file.close()
-    if config and new_cfg != config:
-        log.info("Config change detected! Updating running config with new values.")
-        config = new_cfg
-    else:
-        log.debug(f"Config has not changed since last run.")
-    if not config:
-        log.debug(f"Initialized config for first-time run.")
-        config = new_cfg
-        
+    Any exception is contained here so that one bad alert doesn't take the rest of the batch down with it. Failed alerts are picked up again on the next poll since they won't pass check_if_stored().
+    received is time.monotonic() when the poll that found the alert came back, for the alert-to-feed latency metric.'''
+    alert_id = entry.get("id")
+    try:
+        with metrics.stage("store_alert"):
+            ap.store_alert(entry=entry, config=config)
+    except:
+        log.error(f"Failed to store alert {alert_id}. It will be retried on the next poll.", exc_info=True)
+        registry.forget(entry)
+        metrics.alerts_failed.inc()
+        return False
+    log.info(f"Alert {alert_id} stored, publishing to feed.")
+    fm.update_feed(config=config)
+    metrics.alerts_ingested.inc()
+    if received is not None:
+        metrics.alert_to_feed_seconds.observe(time.monotonic() - received)
+    try:
+        metrics.issued_to_feed_seconds.observe(max(time.time() - float(entry.get("startTimeEpoch")), 0))
+    except (TypeError, ValueError):
+        pass
+    return True
+
+def poll_cycle(pool:ThreadPoolExecutor, workers:int):
+    '''Polls CAR once and stores whatever is new. Returns how many alerts were stored.'''
+    aw.configure(workers=config["audio"]["workers"], queue_size=config["audio"]["queue_size"])
+    audioCache.configure(directory=config["audio"]["cache_dir"], max_mb=config["audio"]["cache_max_mb"])
+    registry.ensure_loaded(config["alerts_dir"])
+    filter_generation = fe.generation
+    fe.load_filters()
+    if fe.generation != filter_generation:
+        ap.invalidate_poll() # Alerts that were blocked before might be allowed now, even if CAR hasn't changed.
+    with metrics.stage("poll"):
+        feed_CAR = ap.poll(config.get("poll_url", "https://alerts.globaleas.org/api/v1/alerts/active"), timeout=config["polling"]["timeout"])
+    received = time.monotonic()
+    if feed_CAR is None:
+        metrics.polls.inc(result="failed" if ap.poll_state["failures"] else "unchanged")
+        log.debug("Nothing new from CAR, skipping filters and storage this loop.")
+        return 0
+    metrics.polls.inc(result="changed")
+    with metrics.stage("filter"):
+        to_store = filter_entries(feed_CAR)
+    if not to_store:
+        return 0
+    log.info(f"Storing {len(to_store)} new alert(s) with {workers} worker(s).")
+    jobs = [pool.submit(profiler.profiled_call, ingest_alert, entry, received) for entry in to_store]
+    failed = sum(1 for job in as_completed(jobs) if not job.result())
+    audio_stats = aw.stats()
+    for state in ("queued", "running", "completed", "failed", "timed_out", "passthrough", "rejected", "cache_hits"):
+        metrics.audio_jobs.set(audio_stats[state], state=state)
+    log.debug(f"Audio workers: {audio_stats['running']} running, {audio_stats['queued']} queued, p50 {audio_stats['duration_p50']} s, p99 {audio_stats['duration_p99']} s, {audio_stats['timed_out']} timed out, {audio_stats['passthrough']} untrimmed, {audio_stats['cache_hits']} from cache.")
+    if failed:
+        log.warning(f"{failed} of {len(jobs)} alert(s) failed to store this poll.")
+        ap.invalidate_poll() # Otherwise an unchanged CAR response would never give them another try.
+    return len(jobs) - failed
 
 def main():
     ## Main Loop
+    pool = None
+    pool_workers = 0
+    global config
+    scheduler = PollScheduler()
+    load_config()
+    profiler.configure(config["profiling"])
+    profiler.install_signal()
+    def config_changed(kind:str):
+        if kind == "filters":
+            ap.invalidate_poll() # Alerts that were blocked before might be allowed now, even if CAR hasn't changed.
+        else:
+            profiler.configure(configManager.current()["profiling"])
+        scheduler.wake() # Poll right away with the new config or filters.
+    configManager.subscribe(config_changed)
+    configManager.watch(write_defaults=True)
+    fm.expiry.start(lambda alert_paths: fm.expire_due(configManager.current(), alert_paths)) # Takes alerts off the feed the moment they expire.
     while True:
-        load_config()
-        feed_CAR = ap.poll(config.get("poll_url", "https://alerts.globaleas.org/api/v1/alerts/active"))
-        for entry in feed_CAR:
-            log.debug(f"Alert received from CAR: {entry}")
-            log.info(f"Found alert on CAR: {entry.get('type')}")
-            timestamp = entry.get("endTime")
-            expired = fm.check_expiry(timestamp=timestamp)
-            if not expired:
-                filter_match = ap.check_filters(entry=entry) 
-                if filter_match:
-                    if not ap.check_if_stored(entry=entry, config=config):
-                        ap.store_alert(entry=entry, config=config)
-                    else:
-                        log.debug(f"We have already downloaded this alert.")
-            else:
-                log.info(f"Alert is expired and won't be processed.")
-        fm.update_feed(config=config)
-        time.sleep(20) # Poll every 20 seconds
+        due = scheduler.wait()
+        profiler.loop_start()
+        if POLL in due:
+            started = time.monotonic()
+            config = configManager.current()
+            scheduler.configure(config["polling"])
+            workers = max(1, config["ingest"]["workers"])
+            if workers != pool_workers: # (Re)create the worker pool on first run or when the config changes.
+                if pool:
+                    pool.shutdown(wait=True)
+                log.debug(f"Starting ingest worker pool with {workers} worker(s).")
+                pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+                pool_workers = workers
+            if poll_cycle(pool, workers):
+                scheduler.new_alerts()
+            scheduler.poll_done(started, ap.poll_state["failures"])
+        if EXPIRY in due:
+            fm.update_feed(config=config) # Full rescan of alerts_dir as a safety net, for alerts added or removed behind our back. Only re-writes the feed if something changed.
+            scheduler.expiry_done()
+        if config["metrics"]["enabled"]:
+            metrics.write(config["metrics"]["path"])
+        profiler.loop_end()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,88 @@
+## capSerializer writes the CAP 1.2 alert.xml for each alert. Most of the document never changes from one alert to the next, so it's pre-rendered
+## once as a handful of text chunks, and only the parts that do change (identifier, times, event, description, audio and the geocodes) are escaped
+## and dropped in between them. The output is byte for byte what ElementTree gave us with ET.indent(space="  ") and ET.tostring(encoding="utf-8",
+## xml_declaration=True), since ENDECs out there have been parsing that for years. benchmark.py checks that and times the two against each other.
+CAP_NAMESPACE = "urn:oasis:names:tc:emergency:cap:1.2"
+TIMEZONE = "-00:00" # dasdec requires timezone or else it gets upsetti spaghetti
+STATIC_PARAMETERS = ( # Come after EAS-ORG, which is the alert's originator.
+    ("timezone", "UTC"),
+    ("BLOCKCHANNEL", "CMAS")
+)
+
+def _escape(text:str):
+    '''Escapes element text the way ElementTree does. Quotes are left alone, they only need escaping in attributes.'''
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+def _element(indent:str, tag:str, text:str):
+    '''One element with text on its own line. ElementTree closes an element with no text as <tag />, so this does too.'''
+    if not text:
+        return f"{indent}<{tag} />\n"
+    return f"{indent}<{tag}>{_escape(text)}</{tag}>\n"
+
+def _value_pair(indent:str, tag:str, value_name:str, value:str):
+    return f"{indent}<{tag}>\n" + _element(indent + "  ", "valueName", value_name) + _element(indent + "  ", "value", value) + f"{indent}</{tag}>\n"
+
+## Pre-rendered skeleton. Each chunk ends right where the next dynamic field starts.
+_HEAD = f"<?xml version='1.0' encoding='utf-8'?>\n<alert xmlns=\"{CAP_NAMESPACE}\">\n"
+_AFTER_IDENTIFIER = _element("  ", "sender", "BOILER")
+_AFTER_SENT = "".join(_element("  ", tag, text) for tag, text in (
+    ("status", "Actual"),
+    ("msgType", "Alert"),
+    ("source", "BOILER-CAP"),
+    ("scope", "Public"),
+    ("addresses", "0"),
+    ("code", "IPAWSv1.0")
+)) + "  <info>\n" + "".join(_element("    ", tag, text) for tag, text in (
+    ("language", "en-US"), # Uhhh. Well. Let's hope none of the alerts are in Spanish, I guess. Aún es imperfecta!
+    ("category", "Safety") # Don't know why this matters other than IPAWS filtering.
+))
+_AFTER_EVENT = "".join(_element("    ", tag, text) for tag, text in (
+    ("urgency", "Immediate"), # Do the ENDECs even parse this info?
+    ("severity", "Severe"), # Again. Do they even parse this?
+    ("certainty", "Observed") # Yeah bro, I saw the Required Monthly Test, it was happening down the street.
+)) + "    <eventCode>\n" + _element("      ", "valueName", "SAME")
+_AFTER_EXPIRES = _element("    ", "senderName", "BOILER BY CABLE CONTRIBUTES TO LIFE")
+_STATIC_PARAMETERS = "".join(_value_pair("    ", "parameter", name, value) for name, value in STATIC_PARAMETERS)
+_RESOURCE_HEAD = "    <resource>\n" + _element("      ", "resourceDesc", "EAS Broadcast Content") + _element("      ", "mimeType", "audio/x-ipaws-audio-mp3") # It'll always be mp3
+_RESOURCE_TAIL = "    </resource>\n"
+_GEOCODE_HEAD = "      <geocode>\n" + _element("        ", "valueName", "SAME")
+_GEOCODE_TAIL = "      </geocode>\n"
+_TAIL = "  </info>\n</alert>"
+
+def geocodes(fips_codes):
+    '''Yields the <area> element a chunk at a time, one per geocode, so an alert for a few hundred counties never has to be built up in one piece.'''
+    empty = True
+    for fips in fips_codes:
+        if empty:
+            yield "    <area>\n"
+            empty = False
+        yield _GEOCODE_HEAD + _element("        ", "value", str(fips)) + _GEOCODE_TAIL
+    yield "    <area />\n" if empty else "    </area>\n"
+
+def chunks(alert_hash:str, event:str, event_name:str, effective:str, expires:str, description:str, originator:str, audio_url:str = None, fips_codes = ()):
+    '''Yields the CAP document as text. effective and expires are the UTC times from CAR (no timezone), and audio_url is left out of the document when it's None.'''
+    effective = effective + TIMEZONE
+    yield (_HEAD + _element("  ", "identifier", f"Boiler-{alert_hash}") + _AFTER_IDENTIFIER + _element("  ", "sent", effective) + _AFTER_SENT
+           + _element("    ", "event", event_name) + _AFTER_EVENT + _element("      ", "value", event) + "    </eventCode>\n"
+           + _element("    ", "effective", effective) + _element("    ", "expires", expires + TIMEZONE) + _AFTER_EXPIRES
+           + _element("    ", "headline", f"{event_name} via Boiler") + _element("    ", "description", description)
+           + _value_pair("    ", "parameter", "EAS-ORG", originator) + _STATIC_PARAMETERS)
+    if audio_url:
+        yield _RESOURCE_HEAD + _element("      ", "uri", audio_url) + _RESOURCE_TAIL
+    yield from geocodes(fips_codes)
+    yield _TAIL
+
+def serialize(*args, **kwargs):
+    '''Returns the CAP document as UTF-8 bytes. Takes the same arguments as chunks().'''
+    return "".join(chunks(*args, **kwargs)).encode("utf-8", "xmlcharrefreplace")
+
+def write(file, *args, **kwargs):
+    '''Streams the CAP document into a file opened in binary mode. Takes the same arguments as chunks().'''
+    for chunk in chunks(*args, **kwargs):
+        file.write(chunk.encode("utf-8", "xmlcharrefreplace"))
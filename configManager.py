@@ -0,0 +1,285 @@
+## configManager owns boiler.cfg for every Boiler process. The file is validated once whenever it changes and published as a read-only snapshot,
+## so the ingest loop and the web workers always agree on what the config is without re-reading it every time they need a value.
+## boiler.cfg and filters.cfg are watched with inotify on Linux, or by checking their modification times every couple of seconds everywhere else.
+import ctypes, ctypes.util, json, logging, os, select, struct, threading, time
+from types import MappingProxyType
+import filterEngine as fe
+
+log = logging.getLogger(__name__)
+
+CONFIG_PATH = "boiler.cfg"
+FILTERS_PATH = "filters.cfg"
+POLL_INTERVAL = 2.0 # How often files are checked when inotify isn't available
+INOTIFY_SAFETY_INTERVAL = 30.0 # With inotify, files are still checked this often in case an event was missed
+SETTLE_TIME = 0.1 # Editors often write a file in several steps, so wait for the events to stop before reading it
+
+_lock = threading.Lock()
+_snapshot = None
+generation = 0 # Bumped every time a different config is published
+_subscribers = []
+_watcher = None
+_watcher_pid = None
+
+def validate(cfg:dict):
+    '''Returns a complete config built from cfg, with anything that's missing or the wrong type set back to its default value.'''
+    # We'll load the current config values as a new config, if they exist, and if not, the values will be set back to the default.
+    return {
+        "poll_url": str(cfg.get("poll_url", "https://alerts.globaleas.org/api/v1/alerts/active")),
+        "alerts_dir": str(cfg.get("alerts_dir", "alerts")),
+        "archive_dir": str(cfg.get("archive_dir", "archive")),
+        "archive": {
+            "format": str(cfg.get("archive", {}).get("format", "segments")),
+            "audio": bool(cfg.get("archive", {}).get("audio", True)),
+            "segment_max_mb": float(cfg.get("archive", {}).get("segment_max_mb", 256)),
+            "segment_max_days": float(cfg.get("archive", {}).get("segment_max_days", 30))
+        },
+        "web": {
+            "flask": {
+                "enabled": bool(cfg.get("web", {}).get("flask", {}).get("enabled", True)),
+                "host_address": str(cfg.get("web", {}).get("flask", {}).get("host_address", "127.0.0.1")),
+                "host_port": int(cfg.get("web", {}).get("flask", {}).get("host_port", 8080))
+            },
+            "server": {
+                "mode": str(cfg.get("web", {}).get("server", {}).get("mode", "production")),
+                "workers": int(cfg.get("web", {}).get("server", {}).get("workers", 0)),
+                "threads": int(cfg.get("web", {}).get("server", {}).get("threads", 8))
+            },
+            "push": {
+                "enabled": bool(cfg.get("web", {}).get("push", {}).get("enabled", False)),
+                "host_address": str(cfg.get("web", {}).get("push", {}).get("host_address", "0.0.0.0")),
+                "port": int(cfg.get("web", {}).get("push", {}).get("port", 8081)),
+                "keepalive": float(cfg.get("web", {}).get("push", {}).get("keepalive", 15)),
+                "long_poll_timeout": float(cfg.get("web", {}).get("push", {}).get("long_poll_timeout", 30)),
+                "max_clients": int(cfg.get("web", {}).get("push", {}).get("max_clients", 10000))
+            },
+            "root_url": str(cfg.get("web", {}).get("root_url", "https://your-domain.or.ip-address:port/boiler")),
+            "alerts_suffix": str(cfg.get("web", {}).get("alerts_suffix", "/IPAWSOPEN_EAS_SERVICE/rest/alerts")),
+            "feed_suffix": str(cfg.get("web", {}).get("feed_suffix", "/IPAWSOPEN_EAS_SERVICE/rest/feed")),
+            "update_suffix": str(cfg.get("web", {}).get("update_suffix", "/IPAWSOPEN_EAS_SERVICE/rest/update"))
+        },
+        "audio": {
+            "store_local": bool(cfg.get("audio", {}).get("store_local", True)),
+            "trim_headers": bool(cfg.get("audio", {}).get("trim_headers", True)),
+            "attn_detector": str(cfg.get("audio", {}).get("attn_detector", "goertzel")),
+            "workers": int(cfg.get("audio", {}).get("workers", 0)),
+            "queue_size": int(cfg.get("audio", {}).get("queue_size", 32)),
+            "job_timeout": float(cfg.get("audio", {}).get("job_timeout", 60)),
+            "cache_dir": str(cfg.get("audio", {}).get("cache_dir", "audio-cache")),
+            "cache_max_mb": float(cfg.get("audio", {}).get("cache_max_mb", 1024))
+        },
+        "polling": {
+            "interval": float(cfg.get("polling", {}).get("interval", 20)),
+            "burst_interval": float(cfg.get("polling", {}).get("burst_interval", 5)),
+            "burst_duration": float(cfg.get("polling", {}).get("burst_duration", 120)),
+            "timeout": float(cfg.get("polling", {}).get("timeout", 10)),
+            "backoff_max": float(cfg.get("polling", {}).get("backoff_max", 300)),
+            "backoff_jitter": float(cfg.get("polling", {}).get("backoff_jitter", 0.2)),
+            "expiry_interval": float(cfg.get("polling", {}).get("expiry_interval", 60))
+        },
+        "ingest": {
+            "workers": int(cfg.get("ingest", {}).get("workers", 4))
+        },
+        "index": {
+            "enabled": bool(cfg.get("index", {}).get("enabled", True)),
+            "path": str(cfg.get("index", {}).get("path", "alerts.db"))
+        },
+        "metrics": {
+            "enabled": bool(cfg.get("metrics", {}).get("enabled", True)),
+            "path": str(cfg.get("metrics", {}).get("path", "metrics.prom"))
+        },
+        "profiling": {
+            "enabled": bool(cfg.get("profiling", {}).get("enabled", False)),
+            "iterations": int(cfg.get("profiling", {}).get("iterations", 10)),
+            "top": int(cfg.get("profiling", {}).get("top", 30)),
+            "keep": int(cfg.get("profiling", {}).get("keep", 10))
+        },
+        "delete_on_expire": bool(cfg.get("delete_on_expire", True)),
+        "trim_encoder_prefix": bool(cfg.get("trim_encoder_prefix", True))
+    }
+
+def freeze(value):
+    '''Makes a read-only copy of a config: dicts become MappingProxyTypes and lists become tuples. Reading it works just like the plain dict.'''
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+def thaw(value):
+    '''The opposite of freeze(), for when a snapshot needs to be changed or written out as JSON.'''
+    if isinstance(value, MappingProxyType):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+def _read(path:str):
+    '''Returns the parsed config file, or None if it's missing or can't be read.'''
+    try:
+        with open(path, "r") as cfg_file: # Yeah, sorry, this means you need to run this script in its working directory.
+            cfg = json.load(cfg_file)
+            cfg_file.close()
+        if isinstance(cfg, dict):
+            return cfg
+        log.error(f"'{path}' doesn't contain a JSON object!")
+    except FileNotFoundError:
+        log.error(f"'{path}' not found in working directory!")
+    except json.decoder.JSONDecodeError:
+        log.error(f"'{path}' was not properly formatted as JSON!")
+    except:
+        log.error(f"Something unexpected happened while trying to load the config file. You can find out more in the traceback below!", exc_info=True)
+    return None
+
+def load(path:str = CONFIG_PATH, write_defaults:bool = False):
+    '''Reads and validates the config file and publishes it as the current snapshot. Returns the snapshot.
+
+    With write_defaults, missing or invalid values are written back to the file with their defaults. Only the ingest process (boiler.py) does this, so that two processes never fight over the file.
+    If the file can't be read after a config has already been loaded, the current snapshot is kept, so a half-saved edit doesn't reset everything.'''
+    global _snapshot, generation
+    cfg = _read(path)
+    if cfg is None:
+        if _snapshot is not None:
+            log.error(f"Keeping the config that was loaded before. Fix '{path}' and it will be picked up automatically.")
+            return _snapshot
+        log.error(f"Config will be {'re-written and ' if write_defaults else ''}set to default values.")
+        cfg = {}
+    new_cfg = validate(cfg)
+    if write_defaults and new_cfg != cfg: # This condition would only ever be met if a key was reset to the default value.
+        difference = new_cfg.keys() - cfg.keys()
+        log.warning(f"Some config items were missing or invalid and reset to the default values: {difference}")
+        log.info(f"Overwriting config file '{path}'")
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as cfg_file:
+            json.dump(obj=new_cfg, fp=cfg_file, indent=2)
+            cfg_file.close()
+        os.replace(temp_path, path)
+    with _lock:
+        if _snapshot is not None and thaw(_snapshot) == new_cfg:
+            log.debug(f"Config has not changed since it was last loaded.")
+            return _snapshot
+        if _snapshot is None:
+            log.debug(f"Initialized config for first-time run.")
+        else:
+            log.info("Config change detected! Updating running config with new values.")
+        _snapshot = freeze(new_cfg)
+        generation += 1
+        return _snapshot
+
+def current():
+    '''Returns the current config snapshot, loading it on first use. Also makes sure this process is watching the config for changes.'''
+    if _snapshot is None:
+        load()
+    if _watcher_pid != os.getpid(): # Gunicorn workers are forked, and threads don't survive a fork.
+        watch()
+    return _snapshot
+
+def subscribe(callback):
+    '''Registers callback(kind) to be called from the watcher thread after a reload. kind is "config" when boiler.cfg produced a new snapshot and "filters" when filters.cfg was re-compiled.'''
+    _subscribers.append(callback)
+
+def _notify(kind:str):
+    for callback in list(_subscribers):
+        try:
+            callback(kind)
+        except:
+            log.error(f"Config subscriber {callback} failed.", exc_info=True)
+
+class _Inotify:
+    '''The bare minimum of inotify, through ctypes so there's nothing extra to install. Watches directories rather than files, since editors and
+    our own os.replace() swap in a new file instead of writing the old one.'''
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, directories):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        for directory in directories:
+            if libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK) < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+
+    def read(self, timeout:float):
+        '''Waits up to timeout seconds and returns the names of the files that had events.'''
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        names = set()
+        while ready:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                names.add(os.fsdecode(data[offset:offset + length].rstrip(b"\0")))
+                offset += length
+            ready, _, _ = select.select([self.fd], [], [], SETTLE_TIME)
+        return names
+
+def _stamp(path:str):
+    try:
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    except FileNotFoundError:
+        return None
+
+class _Watcher(threading.Thread):
+    def __init__(self, config_path:str, filters_path:str, write_defaults:bool):
+        super().__init__(daemon=True, name="config-watcher")
+        self.write_defaults = write_defaults
+        self.paths = {"config": config_path, "filters": filters_path}
+        self.stamps = {kind: _stamp(path) for kind, path in self.paths.items()}
+        try:
+            self.inotify = _Inotify({os.path.dirname(os.path.abspath(path)) for path in self.paths.values()})
+            log.debug("Watching the config with inotify.")
+        except (OSError, AttributeError):
+            self.inotify = None
+            log.debug(f"inotify isn't available, checking the config every {POLL_INTERVAL} seconds instead.")
+
+    def run(self):
+        while True:
+            if self.inotify:
+                names = self.inotify.read(INOTIFY_SAFETY_INTERVAL)
+                if names and not names & {os.path.basename(path) for path in self.paths.values()}:
+                    continue
+            else:
+                time.sleep(POLL_INTERVAL)
+            for kind, path in self.paths.items():
+                stamp = _stamp(path)
+                if stamp == self.stamps[kind]:
+                    continue
+                self.stamps[kind] = stamp
+                try:
+                    self.reload(kind, path)
+                except:
+                    log.error(f"Couldn't reload '{path}'.", exc_info=True)
+
+    def reload(self, kind:str, path:str):
+        if kind == "config":
+            previous = generation
+            load(path, write_defaults=self.write_defaults)
+            if generation != previous:
+                _notify(kind)
+        else:
+            previous = fe.generation
+            fe.load_filters(path, force=True)
+            if fe.generation != previous:
+                _notify(kind)
+
+def watch(config_path:str = CONFIG_PATH, filters_path:str = FILTERS_PATH, write_defaults:bool = False):
+    '''Starts watching boiler.cfg and filters.cfg in the background (once per process). While the watcher runs, filterEngine stops checking filters.cfg on its own.'''
+    global _watcher, _watcher_pid
+    with _lock:
+        if _watcher_pid == os.getpid():
+            return
+        _watcher = _Watcher(config_path, filters_path, write_defaults)
+        _watcher_pid = os.getpid()
+        fe.watched = True
+        _watcher.start()
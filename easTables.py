@@ -0,0 +1,94 @@
+## easTables loads the EAS lookup tables from dicts.json once, the first time they're needed, and shares them read-only with everything else.
+## Run this file directly to build dicts.cache, a pickled copy of the tables that loads faster than the JSON. It's thrown away automatically once dicts.json changes.
+import json, logging, os, pickle, threading
+from types import MappingProxyType
+
+log = logging.getLogger(__name__)
+
+SOURCE_PATH = "dicts.json"
+CACHE_PATH = "dicts.cache"
+TABLES = ("SAME", "SUBDIV", "ORGS", "ORGS2", "EVENTS")
+
+_lock = threading.Lock()
+_tables = None
+
+def _source_stamp(path:str):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def _read_cache(stamp):
+    try:
+        with open(CACHE_PATH, "rb") as cache_file:
+            cached = pickle.load(cache_file)
+            cache_file.close()
+    except FileNotFoundError:
+        return None
+    except:
+        log.warning(f"'{CACHE_PATH}' couldn't be read, falling back to '{SOURCE_PATH}'.", exc_info=True)
+        return None
+    if cached.get("stamp") != stamp:
+        log.debug(f"'{CACHE_PATH}' is older than '{SOURCE_PATH}', ignoring it.")
+        return None
+    return cached.get("tables")
+
+def _read_source():
+    with open(SOURCE_PATH, "r") as EASdictsfile:
+        eas_dicts = json.load(EASdictsfile)
+        EASdictsfile.close()
+    return {name: {str(code): str(value) for code, value in eas_dicts.get(name, {}).items()} for name in TABLES}
+
+def build_cache():
+    '''Writes dicts.cache from the current dicts.json.'''
+    stamp = _source_stamp(SOURCE_PATH)
+    tables = _read_source()
+    temp_path = f"{CACHE_PATH}.tmp"
+    with open(temp_path, "wb") as cache_file:
+        pickle.dump({"stamp": stamp, "tables": tables}, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        cache_file.close()
+    os.replace(temp_path, CACHE_PATH)
+    log.info(f"Built '{CACHE_PATH}' from '{SOURCE_PATH}'.")
+
+def tables():
+    '''Returns every lookup table as a read-only mapping of name -> {code: value}. Loaded once on first use; if dicts.json can't be read, the tables are empty.'''
+    global _tables
+    if _tables is not None:
+        return _tables
+    with _lock:
+        if _tables is None:
+            loaded = None
+            try:
+                stamp = _source_stamp(SOURCE_PATH)
+                loaded = _read_cache(stamp) or _read_source()
+            except:
+                log.error(f"Couldn't load EAS dictionaries from {SOURCE_PATH}.", exc_info=True)
+                loaded = {}
+            _tables = MappingProxyType({name: MappingProxyType(loaded.get(name, {})) for name in TABLES})
+            log.debug(f"EAS lookup tables loaded: " + ", ".join(f"{name} ({len(table)})" for name, table in _tables.items()))
+    return _tables
+
+def event_name(code:str, default:str = "Unknown Event"):
+    return tables()["EVENTS"].get(code, default)
+
+def originator_name(code:str, default:str = "Unknown Originator"):
+    return tables()["ORGS2"].get(code, default)
+
+def area_name(fips:str, default:str = "Unknown Area"):
+    '''Looks up a 6-digit SAME location code (PSSCCC). The first digit is the county subdivision, which gets prefixed onto the county name.'''
+    fips = str(fips)
+    county = tables()["SAME"].get(fips[-5:])
+    if county is None:
+        return default
+    return tables()["SUBDIV"].get(fips[:1], "") + county if len(fips) == 6 else county
+
+def is_known_event(code:str):
+    return code in tables()["EVENTS"]
+
+def is_known_originator(code:str):
+    return code in tables()["ORGS"]
+
+
+if __name__ == "__main__":
+    import coloredlogs
+    log.setLevel(logging.DEBUG)
+    coloredlogs.install(level="DEBUG")
+    build_cache()
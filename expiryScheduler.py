@@ -0,0 +1,56 @@
+## expiryScheduler takes alerts off the feed at the moment they expire. Active alerts sit in a min-heap ordered by their end time (endTimeEpoch from
+## CAR), and a thread sleeps until the earliest one is due, so nothing has to look at the alerts that aren't expiring. Alerts that were removed or
+## re-stored with a new end time in the meantime are left in the heap and simply skipped by the callback when they come up.
+import heapq, logging, threading, time
+
+log = logging.getLogger(__name__)
+
+MAX_WAIT = 60.0 # Never sleep longer than this, in case the system clock was changed.
+
+class ExpiryScheduler:
+    def __init__(self):
+        self._heap = [] # (end time in epoch seconds, key)
+        self._condition = threading.Condition()
+        self._thread = None
+        self._callback = None
+
+    def schedule(self, end_epoch:float, key:str):
+        '''Has key handed to the callback once end_epoch has passed.'''
+        with self._condition:
+            heapq.heappush(self._heap, (end_epoch, key))
+            if self._heap[0] == (end_epoch, key): # New earliest expiry, the thread has to wake up sooner than it planned to.
+                self._condition.notify()
+
+    def next_expiry(self):
+        with self._condition:
+            return self._heap[0][0] if self._heap else None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def start(self, callback):
+        '''Starts the thread. callback(keys) is called with every key that came due at once, and should do its own locking.'''
+        if self._thread:
+            return
+        self._callback = callback
+        self._thread = threading.Thread(target=self._run, name="expiry", daemon=True)
+        self._thread.start()
+
+    def _due(self):
+        with self._condition:
+            while True:
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    due = []
+                    while self._heap and self._heap[0][0] <= now:
+                        due.append(heapq.heappop(self._heap)[1])
+                    return due
+                self._condition.wait(min(self._heap[0][0] - now, MAX_WAIT) if self._heap else MAX_WAIT)
+
+    def _run(self):
+        while True:
+            due = self._due()
+            try:
+                self._callback(due)
+            except:
+                log.error("Something went wrong while expiring alerts.", exc_info=True)
@@ -1,9 +1,18 @@
 import xml.etree.ElementTree as ET
-import os, json, logging, coloredlogs, shutil
+import os, json, logging, coloredlogs, shutil, threading, time
 import datetime as dt
+import alertRegistry as registry
+import easTables as eas
+import pushServer
+import feedStore
+import archiveStore
+import alertIndex
+import expiryScheduler
+import metrics
 
 log = logging.getLogger(__name__)
 
+feed_lock = threading.Lock() # Ingest workers publish to the feed as soon as each alert is stored, so only one of them may rebuild it at a time.
 
 def check_expiry(timestamp:str):
     timestamp_dt = dt.datetime.fromisoformat(timestamp).replace(tzinfo=dt.timezone.utc)
@@ -16,6 +25,26 @@ def check_expiry(timestamp:str):
         expired = False
     return expired
 
+def archive_alert(alert_dir:str, archive_dir:str, settings:dict):
+    '''Archives an expired alert the way the "archive" section of the config asks for: appended to the archive segments (see archiveStore), or moved into archive_dir as a directory.'''
+    if settings["format"] != "segments":
+        move_to_archive(alert_dir=alert_dir, archive_dir=archive_dir)
+        return
+    try:
+        archiveStore.append(archive_dir, alert_dir, settings)
+    except:
+        log.error(f"Couldn't add {alert_dir} to the archive segments, moving the directory to {archive_dir} instead so it isn't lost.", exc_info=True)
+        move_to_archive(alert_dir=alert_dir, archive_dir=archive_dir)
+        return
+    shutil.rmtree(path=alert_dir, ignore_errors=True)
+
+def end_epoch(alert_json:dict):
+    '''Returns when an alert expires in epoch seconds, from endTimeEpoch if CAR sent it or endTime (assumed UTC) if it didn't.'''
+    try:
+        return float(alert_json["endTimeEpoch"])
+    except (KeyError, TypeError, ValueError):
+        return dt.datetime.fromisoformat(alert_json.get("endTime")).replace(tzinfo=dt.timezone.utc).timestamp()
+
 def move_to_archive(alert_dir:str, archive_dir:str):
     if not os.path.exists(archive_dir):
         log.warning(f"Archive directory {archive_dir} doesn't exist! Creating it for you. :)")
@@ -33,27 +62,147 @@ def move_to_archive(alert_dir:str, archive_dir:str):
     except:
         log.error(f"Unexpected error occurred while attempting to move {alert_dir} to archive ({archive_dir}). See below.", exc_info=True)
 
-def update_feed(config:dict):
-    '''Updates the feed XML with all of the active alerts in the alerts_dir. This function pretty much re-builds the XML every single time it runs, since it would be easier to do that instead of manually removing alerts from the feed.'''
-    alerts_dir = config.get("alerts_dir")
-    archive_dir = config.get("archive_dir")
-    config_delete_on_expire = config.get("delete_on_expire") # If this is true, the alerts won't be archived.
-    config_url_root = config.get("web").get("root_url")
-    config_feed_suffix = config.get("web").get("feed_suffix")
-    config_alerts_suffix = config.get("web").get("alerts_suffix")
-    config_feed_url = config_url_root + config_feed_suffix
-    config_alerts_url = config_url_root + config_alerts_suffix
+## The feed is only re-written when the set of active alerts actually changes. Each alert's <entry> is serialized once and cached
+## until its response.json changes, and <updated> in feed.xml/update.xml is the time of the last real change.
+_entry_cache = {} # Alert directory name -> cached entry, see _load_entry()
+expiry = expiryScheduler.ExpiryScheduler() # Every entry that's loaded is scheduled here. boiler.py starts it, see expire_due().
+published = {
+    "entries": None, # Tuple of the fragments that were last written to feed.xml
+    "feed_url": None,
+    "updated": None, # Timestamp of the last change to the feed
+    "generation": 0 # Bumped every time feed.xml/update.xml are re-written
+}
+
+def _utc_now_string():
+    utc_right_now = dt.datetime.now(dt.timezone.utc).isoformat(timespec='milliseconds')
+    return utc_right_now.replace("+00:00", "Z")
+
+def build_entry(alert_json:dict, alerts_url:str, receive_time:str):
+    '''Serializes a single <entry> for the feed, indented to sit directly inside <feed>.'''
+    alert_id = alert_json.get("id")
+    alert_event = alert_json.get("type")
+    alert_url = f"{alerts_url}/{alert_id}/alert.xml"
+    alert_fips = alert_json.get("fipsCodes")
+    alert_fips_1 = alert_fips[0]
+    alert_state_fips = alert_fips_1[1:3] # Thanks, SAGE and Trilithic. No, really, this is stupid. Why are you using this to verify alerts? DAS wasn't smoking whatever crack you two were.
+    alert_receive_time = alert_json.get("boilerTime", receive_time) # receive time so endecs won't pull the same alert constantly, uses UTC now as backup
+    entry = ET.Element("entry")
+    entry_title = ET.SubElement(entry, "title")
+    entry_title.set("type", "text")
+    entry_title.text = alert_event
+    entry_link = ET.SubElement(entry, "link")
+    entry_link.set("href", alert_url)
+    entry_id = ET.SubElement(entry, "id")
+    entry_id.text = alert_url
+    entry_updated = ET.SubElement(entry, "updated")
+    entry_updated.text = alert_receive_time
+    entry_category = ET.SubElement(entry, "category")
+    entry_category.set("term", alert_event)
+    entry_category.set("label", "event")
+    entry_category_2 = ET.SubElement(entry, "category")
+    entry_category_2.set("term", alert_state_fips)
+    entry_category_2.set("label", "statefips")
+    ET.indent(entry, space="  ", level=1)
+    return "  " + ET.tostring(entry, encoding="unicode")
 
+def build_feed(entries, updated:str, feed_url:str):
+    '''Assembles the feed document from already serialized <entry> fragments. Passing no entries gives you update.xml.'''
     root = ET.Element("feed", {"xmlns": "http://www.w3.org/2005/Atom"})
     title = ET.SubElement(root, "title")
     title.set("type", "text")
     title.text = "BOILER EAS FEED"
-    updated = ET.SubElement(root, "updated")
-    utc_right_now = dt.datetime.now(dt.timezone.utc).isoformat(timespec='milliseconds')
-    utc_right_now = utc_right_now.replace("+00:00", "Z")
-    updated.text = utc_right_now
+    updated_element = ET.SubElement(root, "updated")
+    updated_element.text = updated
     feed_id = ET.SubElement(root, "id")
-    feed_id.text = config_feed_url
+    feed_id.text = feed_url
+    ET.indent(root, space="  ", level=0)
+    head, tail = ET.tostring(root, encoding="unicode").rsplit("</id>", 1)
+    document = head + "</id>\n" + "".join(f"{fragment}\n" for fragment in entries) + tail.lstrip()
+    return ("<?xml version='1.0' encoding='utf-8'?>\n" + document).encode("utf-8")
+
+def write_atomic(path:str, data:bytes):
+    '''Writes to a temporary file and swaps it into place, so the web process never serves a half-written file.'''
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(data)
+        file.close()
+    os.replace(temp_path, path)
+
+def _update_index(function, *args):
+    '''Runs an alertIndex update. The index is only for looking things up later, so a problem with it is logged rather than holding up the feed.'''
+    try:
+        function(*args)
+    except:
+        log.warning("Couldn't update the alert index.", exc_info=True)
+
+def _load_entry(alert_path:str, alerts_url:str, index_path:str = None):
+    '''Returns the cached entry for an alert directory, only re-reading response.json if it was modified since the last time. Returns None if the alert isn't complete yet.
+    Alerts are added to the alert index at index_path (if set) whenever their response.json is read.'''
+    alert_xml_path = os.path.join(alert_path, "alert.xml")
+    alert_json_path = os.path.join(alert_path, "response.json")
+    try:
+        stamp = os.stat(alert_json_path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if not os.path.exists(alert_xml_path):
+        return None
+    cached = _entry_cache.get(alert_path)
+    if cached and cached["stamp"] == stamp and cached["alerts_url"] == alerts_url:
+        return cached
+    with open(alert_json_path, "r") as alert_json_file:
+        alert_json = json.load(alert_json_file)
+        alert_json_file.close()
+    log.info(f"Adding alert {alert_json.get('id')} ({eas.event_name(alert_json.get('type'))}) to the feed.")
+    if index_path:
+        _update_index(alertIndex.add, index_path, alert_json)
+    cached = {
+        "stamp": stamp,
+        "alerts_url": alerts_url,
+        "id": alert_json.get("id"),
+        "cacheKey": alert_json.get("cacheKey"),
+        "endEpoch": end_epoch(alert_json),
+        "fragment": build_entry(alert_json, alerts_url, _utc_now_string())
+    }
+    _entry_cache[alert_path] = cached
+    expiry.schedule(cached["endEpoch"], alert_path)
+    return cached
+
+def update_feed(config:dict):
+    '''Updates the feed XML with all of the active alerts in the alerts_dir, expiring any alerts that have passed their end time.
+    
+    feed.xml and update.xml are only re-written if an alert was added or removed since the last time. Safe to call from multiple ingest workers at once.'''
+    with feed_lock, metrics.stage("feed_update"):
+        return _update_feed(config)
+
+def _expire_alert(config:dict, alert_path:str, cached:dict, index_path:str):
+    '''Takes an expired alert off the feed: deletes or archives it, and forgets about it everywhere else.'''
+    alert_id = cached["id"]
+    log.info(f"Alert {alert_id} ({cached['cacheKey']}) has expired!")
+    if config.get("delete_on_expire"): # If this is true, the alerts won't be archived.
+        log.info(f"Deleting alert {alert_id}.")
+        shutil.rmtree(path=alert_path, ignore_errors=True) # thanks linux
+        metrics.alerts_expired.inc(action="deleted")
+        expired_status = "deleted"
+    else:
+        log.info(f"Archiving alert {alert_id}.")
+        archive_alert(alert_dir=alert_path, archive_dir=config.get("archive_dir"), settings=config["archive"])
+        metrics.alerts_expired.inc(action="archived")
+        expired_status = "archived"
+    if index_path:
+        _update_index(alertIndex.set_status, index_path, alert_id, expired_status)
+    registry.remove(alert_id)
+    feedStore.discard(os.path.join(alert_path, "alert.xml"))
+    _entry_cache.pop(alert_path, None)
+
+def _index_path(config:dict):
+    return config["index"]["path"] if config["index"]["enabled"] else None
+
+def _update_feed(config:dict):
+    alerts_dir = config.get("alerts_dir")
+    config_url_root = config.get("web").get("root_url")
+    config_alerts_suffix = config.get("web").get("alerts_suffix")
+    config_alerts_url = config_url_root + config_alerts_suffix
+    index_path = _index_path(config)
 
     # Check to see if the alerts directory even exists first
     if not os.path.exists(alerts_dir):
@@ -63,77 +212,69 @@ def update_feed(config:dict):
     else:
         log.debug(f"OK - {alerts_dir} exists.")
 
-    # Update feed.xml
-    for alert_dir in os.listdir(alerts_dir):
+    entries = []
+    present = set()
+    now = time.time()
+    for alert_dir in sorted(os.listdir(alerts_dir)):
         alert_path = os.path.join(alerts_dir, alert_dir)
-        if os.path.isdir(alert_path):
-            log.debug(alert_path)
-            alert_xml_path = os.path.join(alert_path, "alert.xml")
-            alert_json_path = os.path.join(alert_path, "response.json")
-            if os.path.exists(alert_xml_path) and os.path.exists(alert_json_path):
-                with open(alert_json_path, "r") as alert_json_file:
-                    alert_json = json.load(alert_json_file)
-                    alert_json_file.close()
-                expiration_time = alert_json.get("endTime")
-                alert_id = alert_json.get("id")
-                alert_event = alert_json.get("type")
-                alert_url = f"{config_alerts_url}/{alert_id}/alert.xml"
-                alert_fips = alert_json.get("fipsCodes")
-                alert_fips_1 = alert_fips[0]
-                alert_state_fips = alert_fips_1[1:3] # Thanks, SAGE and Trilithic. No, really, this is stupid. Why are you using this to verify alerts? DAS wasn't smoking whatever crack you two were.
-                alert_receive_time = alert_json.get("boilerTime", utc_right_now) # receive time so endecs won't pull the same alert constantly, uses UTC now as backup
-                expired = check_expiry(expiration_time)
-                if expired: # Expire the alert and move it to the archive if archiving is enabled
-                    log.info(f"Alert {alert_id} ({alert_json.get('cacheKey')}) has expired!")
-                    if config_delete_on_expire:
-                        log.info(f"Deleting alert {alert_id}.")
-                        #os.remove(path=alert_path)
-                        shutil.rmtree(path=alert_path, ignore_errors=True) # thanks linux
-                    else:
-                        log.info(f"Archiving alert {alert_id}.")
-                        move_to_archive(alert_dir=alert_path, archive_dir=archive_dir)
-                else:
-                    log.info(f"Writing alert {alert_id} to feed.")
-                    entry = ET.SubElement(root, "entry")
-                    entry_title = ET.SubElement(entry, "title")
-                    entry_title.set("type", "text")
-                    entry_title.text = alert_event
-                    entry_link = ET.SubElement(entry, "link")
-                    entry_link.set("href", alert_url)
-                    entry_id = ET.SubElement(entry, "id")
-                    entry_id.text = alert_url
-                    entry_updated = ET.SubElement(entry, "updated")
-                    entry_updated.text = alert_receive_time
-                    entry_category = ET.SubElement(entry, "category")
-                    entry_category.set("term", alert_event)
-                    entry_category.set("label", "event")
-                    entry_category_2 = ET.SubElement(entry, "category")
-                    entry_category_2.set("term", alert_state_fips)
-                    entry_category_2.set("label", "statefips")
-
-    xml_tree = ET.ElementTree(root)
-    ET.indent(xml_tree, space="  ", level=0)
-    xml_path = os.path.join(alerts_dir, "feed.xml")
-    xml_tree.write(xml_path, encoding="utf-8", xml_declaration=True)
-    log.debug(ET.tostring(root, encoding='utf-8').decode('utf-8'))
-
-    # Update update.xml
-    root = ET.Element("feed", {"xmlns": "http://www.w3.org/2005/Atom"})
-    title = ET.SubElement(root, "title")
-    title.set("type", "text")
-    title.text = "BOILER EAS FEED"
-    updated = ET.SubElement(root, "updated")
-    utc_right_now = dt.datetime.now(dt.timezone.utc).isoformat(timespec='milliseconds')
-    utc_right_now = utc_right_now.replace("+00:00", "Z")
-    updated.text = utc_right_now
-    feed_id = ET.SubElement(root, "id")
-    feed_id.text = config_feed_url
-    xml_tree = ET.ElementTree(root)
-    ET.indent(xml_tree, space="  ", level=0)
-    xml_path = os.path.join(alerts_dir, "update.xml")
-    xml_tree.write(xml_path, encoding="utf-8", xml_declaration=True)
-    log.debug(ET.tostring(root, encoding='utf-8').decode('utf-8'))
+        if not os.path.isdir(alert_path):
+            continue
+        present.add(alert_path)
+        cached = _load_entry(alert_path, config_alerts_url, index_path)
+        if not cached:
+            continue
+        if cached["endEpoch"] <= now: # Expire the alert and move it to the archive if archiving is enabled
+            _expire_alert(config, alert_path, cached, index_path)
+        else:
+            entries.append(cached["fragment"])
+    for alert_path in _entry_cache.keys() - present: # Directories that were removed behind our back.
+        del _entry_cache[alert_path]
+    return _publish(config, entries)
+
+def expire_due(config:dict, alert_paths:list):
+    '''Called by the expiry scheduler with the alert directories whose end time just passed. Expires them and re-writes the feed from the cached
+    entries of the rest, without listing alerts_dir or opening any of their files. Returns True if the feed was re-written.'''
+    with feed_lock, metrics.stage("expiry"):
+        now = time.time()
+        index_path = _index_path(config)
+        expired = 0
+        for alert_path in alert_paths:
+            cached = _entry_cache.get(alert_path)
+            if cached and cached["endEpoch"] <= now: # Otherwise it's already gone, or was stored again with a later end time.
+                _expire_alert(config, alert_path, cached, index_path)
+                expired += 1
+        if not expired:
+            return False
+        return _publish(config, [cached["fragment"] for alert_path, cached in sorted(_entry_cache.items()) if cached["endEpoch"] > now])
 
+def _publish(config:dict, entries:list):
+    '''Writes feed.xml and update.xml with entries, unless that's exactly what was published last time. Returns True if they were written.'''
+    alerts_dir = config.get("alerts_dir")
+    config_feed_url = config.get("web").get("root_url") + config.get("web").get("feed_suffix")
+    entries = tuple(entries)
+    metrics.feed_alerts.set(len(entries))
+    feed_path = os.path.join(alerts_dir, "feed.xml")
+    update_path = os.path.join(alerts_dir, "update.xml")
+    if entries == published["entries"] and config_feed_url == published["feed_url"] and os.path.exists(feed_path) and os.path.exists(update_path):
+        log.debug(f"No changes to the feed, {len(entries)} active alert(s).")
+        return False
+
+    updated = _utc_now_string()
+    log.info(f"Feed changed, writing {len(entries)} active alert(s) to feed.")
+    feed = build_feed(entries, updated, config_feed_url)
+    update = build_feed((), updated, config_feed_url)
+    with metrics.stage("feed_write"):
+        write_atomic(feed_path, feed)
+        write_atomic(update_path, update)
+    feedStore.put(feed_path, feed)
+    feedStore.put(update_path, update)
+    metrics.feed_publishes.inc()
+    published["entries"] = entries
+    published["feed_url"] = config_feed_url
+    published["updated"] = updated
+    published["generation"] += 1
+    pushServer.notify(config)
+    return True
 
 
 if __name__ == "__main__":
@@ -143,6 +284,16 @@ if __name__ == "__main__":
     "poll_url": "https://alerts.globaleas.org/api/v1/alerts/active",
     "alerts_dir": "alerts",
     "archive_dir": "archive",
+    "archive": {
+        "format": "segments",
+        "audio": True,
+        "segment_max_mb": 256,
+        "segment_max_days": 30
+    },
+    "index": {
+        "enabled": True,
+        "path": "alerts.db"
+    },
     "web": {
         "flask": {
         "enabled": True,
@@ -0,0 +1,34 @@
+## feedStore holds the published documents (feed.xml, update.xml and every alert.xml) in memory for the combined web server mode, where the ingest
+## loop and the web routes run in the same process. Boiler still writes everything to disk so it survives a restart, but requests are answered
+## straight from here, so the web side never has to stat or read a file and can't see one half-written.
+import gzip, hashlib, threading
+import datetime as dt
+
+enabled = False # Turned on by webProcess.py in combined mode. Nothing is kept otherwise.
+_documents = {} # Path on disk -> document
+_lock = threading.Lock()
+
+def document(body:bytes, modified:dt.datetime = None):
+    '''Builds the form webProcess serves a document in: the body, a gzipped copy, an ETag and a Last-Modified time.'''
+    return {
+        "body": body,
+        "gzip": gzip.compress(body, compresslevel=9),
+        "etag": hashlib.sha1(body).hexdigest()[:16],
+        "last_modified": modified or dt.datetime.now(tz=dt.timezone.utc)
+    }
+
+def put(path:str, body:bytes):
+    '''Publishes body as the document at path. Call after it was written to disk.'''
+    if not enabled:
+        return
+    stored = document(body)
+    with _lock:
+        _documents[path] = stored
+
+def get(path:str):
+    '''Returns the document published at path, or None if it wasn't published by this process (look on disk then).'''
+    return _documents.get(path)
+
+def discard(path:str):
+    with _lock:
+        _documents.pop(path, None)
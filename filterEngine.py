@@ -0,0 +1,148 @@
+## filterEngine compiles filters.cfg into an indexed matcher so alerts can be checked without re-reading the file every time.
+## The file is only re-read and re-compiled when its modification time changes, or when configManager says it changed.
+import json, logging, os
+import easTables as eas
+
+log = logging.getLogger(__name__)
+
+FIELDS = ("originators", "events", "fips", "station_ids")
+
+class CompiledFilter:
+    '''A single filter from filters.cfg. Each field is a frozenset of accepted values, or None if the field is a wildcard ('null' or missing in the config).'''
+    __slots__ = ("name", "originators", "events", "fips", "station_ids", "allow")
+
+    def __init__(self, name:str, rules:dict):
+        self.name = name
+        for field in FIELDS:
+            setattr(self, field, _to_set(rules.get(field, None)))
+        self.allow = bool(rules.get("allow", True))
+
+def _to_set(value):
+    '''Filters accept a single string or a list of strings, so both end up as a frozenset here. None stays None so it can be treated as a wildcard.'''
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return frozenset([value])
+    return frozenset(str(v) for v in value)
+
+class FilterMatcher:
+    '''Every filter gets a bit in an integer mask based on its position in filters.cfg. For each field we keep an index of value -> mask of filters that list that value, plus a mask of the filters that don't care about that field at all.
+
+    Matching an alert is then a handful of dict lookups and bitwise ANDs, regardless of how many filters there are, and the lowest set bit is the first filter (top to bottom) that matched.'''
+
+    def __init__(self, filters:dict):
+        self.filters = [CompiledFilter(name, rules or {}) for name, rules in filters.items()]
+        self.index = {field: {} for field in FIELDS}
+        self.wildcard = {field: 0 for field in FIELDS}
+        for position, compiled in enumerate(self.filters):
+            bit = 1 << position
+            for field in FIELDS:
+                values = getattr(compiled, field)
+                if values is None:
+                    self.wildcard[field] |= bit
+                else:
+                    field_index = self.index[field]
+                    for value in values:
+                        field_index[value] = field_index.get(value, 0) | bit
+        self.all_filters = (1 << len(self.filters)) - 1
+
+    def _mask(self, field:str, value):
+        return self.index[field].get(value, 0) | self.wildcard[field]
+
+    def match(self, entry:dict):
+        '''Returns the first CompiledFilter that matches the alert, or None if nothing matched.'''
+        candidates = self.all_filters
+        candidates &= self._mask("originators", entry.get("originator"))
+        if candidates:
+            candidates &= self._mask("events", entry.get("type"))
+        if candidates:
+            fips_index = self.index["fips"]
+            fips_mask = self.wildcard["fips"]
+            for fips in entry.get("fipsCodes") or []:
+                fips_mask |= fips_index.get(fips, 0)
+            candidates &= fips_mask
+        if candidates:
+            candidates &= self._mask("station_ids", str(entry.get("callsign", "")).rstrip()) # Remove any left over spaces in the station ID.
+        if not candidates:
+            return None
+        first = (candidates & -candidates).bit_length() - 1
+        return self.filters[first]
+
+## Compiled filters are cached at module level and only rebuilt when the file on disk changes.
+matcher = None
+generation = 0 # Bumped every time the filters are re-compiled, so anything that caches filter results knows to throw them away.
+_loaded_stamp = None
+watched = False # Set by configManager while it watches filters.cfg, after which the file isn't checked on every call anymore.
+
+def _file_stamp(path:str):
+    try:
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        return "missing"
+
+def load_filters(path:str = "filters.cfg", force:bool = False):
+    '''Returns the compiled FilterMatcher for the given filters file, re-compiling it only if the file has changed since the last call.
+    If configManager is watching the file, the compiled filters are returned as they are unless force is set.
+
+    Returns None if the file is missing or broken, in which case every alert should be allowed.'''
+    global matcher, generation, _loaded_stamp
+    if watched and not force and _loaded_stamp is not None:
+        return matcher
+    stamp = _file_stamp(path)
+    if stamp == _loaded_stamp:
+        return matcher
+    _loaded_stamp = stamp
+    generation += 1
+    matcher = None
+    if stamp == "missing":
+        log.error(f"'{path}' not found in working directory! Ignoring filters, all alerts will be placed on the feed.")
+        return matcher
+    try:
+        with open(path, "r") as filter_file:
+            filters = json.load(filter_file)
+            filter_file.close()
+        matcher = FilterMatcher(filters)
+        _check_codes(matcher)
+        log.info(f"Compiled {len(matcher.filters)} filter(s) from '{path}'.")
+    except json.decoder.JSONDecodeError:
+        log.error(f"'{path}' is not formatted properly and could not be decoded! Filters will be ignored and all alerts will be placed on the feed.")
+    except:
+        log.error(f"An unexpected error occurred while trying to load the filters configuration.", exc_info=True)
+    return matcher
+
+def _check_codes(compiled_matcher:FilterMatcher):
+    '''Warns about event and originator codes that aren't real SAME codes, since they're probably typos and the filter will never match them.'''
+    for compiled in compiled_matcher.filters:
+        for code in compiled.events or ():
+            if not eas.is_known_event(code):
+                log.warning(f"Filter '{compiled.name}' lists an unknown event code '{code}'.")
+        for code in compiled.originators or ():
+            if not eas.is_known_originator(code):
+                log.warning(f"Filter '{compiled.name}' lists an unknown originator code '{code}'.")
+
+def _describe(entry:dict):
+    eas_fips = entry.get("fipsCodes") or []
+    return f"{entry.get('originator')}-{entry.get('type')}-" + ''.join(f"{fips}-" for fips in eas_fips) + f"{str(entry.get('callsign', '')).rstrip()}"
+
+def _decide(current_matcher, entry:dict):
+    if current_matcher is None:
+        return True
+    matched = current_matcher.match(entry)
+    if matched is None:
+        log.info(f"Alert '{_describe(entry)}' did not match any filters. It will be processed anyway.")
+        return True
+    if matched.allow:
+        log.info(f"Alert '{_describe(entry)}' matched filter '{matched.name}', which is set to ALLOW! It will be processed.")
+    else:
+        log.info(f"Alert '{_describe(entry)}' matched filter '{matched.name}', which is set to BLOCK! It will NOT be processed.")
+    return matched.allow
+
+def check(entry:dict, path:str = "filters.cfg"):
+    '''Returns True if the alert should be processed, or False if it was blocked by a filter.'''
+    return _decide(load_filters(path), entry)
+
+def check_batch(entries:list, path:str = "filters.cfg"):
+    '''Same as check(), but for every entry of a poll at once. The filters file is only checked for changes once for the whole batch. Returns a list of True/False in the same order as entries.'''
+    current_matcher = load_filters(path)
+    return [_decide(current_matcher, entry) for entry in entries]
@@ -0,0 +1,134 @@
+## loadTest hammers a running Boiler web service the way a room full of ENDECs would: every client polls the feed, grabs alert.xml and downloads the audio.
+## Run it from the working directory of Boiler while webProcess.py is running. It reads boiler.cfg to find the routes and picks an alert from the live feed.
+import argparse, http.client, json, sys, threading, time
+import xml.etree.ElementTree as ET
+from urllib.parse import urlsplit
+
+def load_config(path:str = "boiler.cfg"):
+    with open(path, "r") as config_file:
+        config = json.load(config_file)
+        config_file.close()
+    return config
+
+def percentile(values:list, fraction:float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def _get(host:str, port:int, path:str):
+    connection = http.client.HTTPConnection(host, port, timeout=10)
+    connection.request("GET", path)
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    if response.status != 200:
+        raise RuntimeError(f"{path} returned HTTP {response.status}.")
+    return body
+
+def find_alert(host:str, port:int, feed_path:str):
+    '''Returns the alert.xml path of the first alert on the feed, or None if the feed is empty.'''
+    for element in ET.fromstring(_get(host, port, feed_path)).iter():
+        if element.tag.endswith("entry"):
+            for child in element:
+                if child.tag.endswith("id") and child.text:
+                    return urlsplit(child.text).path
+    return None
+
+def find_audio(host:str, port:int, alert_path:str):
+    '''Returns the path of the audio that alert.xml points receivers to, or None if it has no audio.'''
+    for element in ET.fromstring(_get(host, port, alert_path)).iter():
+        if element.tag.endswith("uri") and element.text:
+            return urlsplit(element.text).path
+    return None
+
+class Client(threading.Thread):
+    '''One simulated receiver. Keeps a single connection open and cycles through the routes until the deadline.'''
+
+    def __init__(self, host:str, port:int, routes:dict, deadline:float, results:dict, lock:threading.Lock):
+        super().__init__(daemon=True)
+        self.host = host
+        self.port = port
+        self.routes = routes
+        self.deadline = deadline
+        self.results = results
+        self.lock = lock
+
+    def run(self):
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=10)
+        latencies = {name: [] for name in self.routes}
+        errors = {name: 0 for name in self.routes}
+        while time.perf_counter() < self.deadline:
+            for name, path in self.routes.items():
+                started = time.perf_counter()
+                try:
+                    connection.request("GET", path)
+                    response = connection.getresponse()
+                    response.read()
+                    if response.status != 200:
+                        errors[name] += 1
+                        continue
+                    latencies[name].append(time.perf_counter() - started)
+                except (OSError, http.client.HTTPException):
+                    errors[name] += 1
+                    connection.close()
+                    connection = http.client.HTTPConnection(self.host, self.port, timeout=10)
+        connection.close()
+        with self.lock:
+            for name in self.routes:
+                self.results[name]["latencies"].extend(latencies[name])
+                self.results[name]["errors"] += errors[name]
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the Boiler web service.")
+    parser.add_argument("--host", default=None, help="Host to connect to (defaults to web.flask.host_address from boiler.cfg)")
+    parser.add_argument("--port", type=int, default=None, help="Port to connect to (defaults to web.flask.host_port from boiler.cfg)")
+    parser.add_argument("--clients", type=int, default=50, help="Number of simulated receivers (default 50)")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to run for (default 10)")
+    parser.add_argument("--alert", default=None, help="Alert ID to fetch (defaults to the first alert on the feed)")
+    parser.add_argument("--config", default="boiler.cfg", help="Path to boiler.cfg")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    host = args.host or config["web"]["flask"]["host_address"]
+    if host == "0.0.0.0":
+        host = "127.0.0.1"
+    port = args.port or int(config["web"]["flask"]["host_port"])
+    feed_path = config["web"]["feed_suffix"]
+    alerts_suffix = config["web"]["alerts_suffix"]
+    alert_path = f"{alerts_suffix}/{args.alert}/alert.xml" if args.alert else find_alert(host, port, feed_path)
+    routes = {"feed": feed_path}
+    if alert_path:
+        routes["alert.xml"] = alert_path
+        audio_path = find_audio(host, port, alert_path)
+        if audio_path and audio_path.startswith(alerts_suffix): # Audio that isn't stored locally is served by someone else.
+            routes["audio"] = audio_path
+        else:
+            print("That alert has no locally stored audio, the audio route will not be tested.")
+    else:
+        print("There are no alerts on the feed, only the feed will be tested. Send one with sendTest.py, or pass --alert.")
+
+    print(f"Running {args.clients} client(s) against http://{host}:{port} for {args.duration} seconds...")
+    results = {name: {"latencies": [], "errors": 0} for name in routes}
+    lock = threading.Lock()
+    started = time.perf_counter()
+    deadline = started + args.duration
+    clients = [Client(host, port, routes, deadline, results, lock) for _ in range(args.clients)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - started
+
+    print(f"{'route':<12}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    failed = False
+    for name, result in results.items():
+        latencies = result["latencies"]
+        p50, p99 = percentile(latencies, 0.50), percentile(latencies, 0.99)
+        print(f"{name:<12}{len(latencies):>10}{result['errors']:>8}{len(latencies) / elapsed:>10.1f}"
+              f"{(p50 * 1000 if p50 is not None else 0):>10.1f}{(p99 * 1000 if p99 is not None else 0):>10.1f}")
+        failed = failed or result["errors"] > 0
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+## metrics keeps counters and latency histograms for every stage of Boiler and renders them in the Prometheus text format.
+## The ingest process (boiler.py) writes its metrics to a file after every loop, and webProcess serves that file along with its own on /metrics.
+## Audio jobs run in separate processes, so they send their metrics back with their result and those get merged in here.
+import bisect, logging, os, threading, time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600, 1800)
+
+_lock = threading.Lock()
+_metrics = {} # Name -> metric, in the order they were defined
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name:str, help:str, labelnames:tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {} # Tuple of label values -> value
+        with _lock:
+            _metrics[name] = self
+
+    def _key(self, labels:dict):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key:tuple, extra:str = ""):
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount:float = 1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def _render(self, lines:list):
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{self._labels(key)} {_number(value)}")
+
+    def _merge(self, key:tuple, value):
+        self.values[key] = self.values.get(key, 0) + value
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value:float, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = value
+
+    def _merge(self, key:tuple, value):
+        self.values[key] = value
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name:str, help:str, labelnames:tuple = (), buckets:tuple = STAGE_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames)
+
+    def observe(self, value:float, **labels):
+        key = self._key(labels)
+        with _lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0] # Per-bucket counts (not cumulative), sum, count
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render(self, lines:list):
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % _number(bound)
+                lines.append(f"{self.name}_bucket{self._labels(key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{self._labels(key, le)} {count}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {_number(total)}")
+            lines.append(f"{self.name}_count{self._labels(key)} {count}")
+
+    def _merge(self, key:tuple, value):
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0] = [mine + theirs for mine, theirs in zip(state[0], value[0])]
+        state[1] += value[1]
+        state[2] += value[2]
+
+def _escape(value:str):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+## Everything Boiler measures. The stages are listed in docs/CONFIG.md under metrics.
+stage_seconds = Histogram("boiler_stage_seconds", "Time spent in each stage of polling, storing and publishing alerts.", ("stage",))
+alert_to_feed_seconds = Histogram("boiler_alert_to_feed_seconds", "Time from an alert showing up in a CAR poll to it being on the published feed.", buckets=LATENCY_BUCKETS)
+issued_to_feed_seconds = Histogram("boiler_alert_issued_to_feed_seconds", "Time from an alert's start time on CAR to it being on the published feed.", buckets=LATENCY_BUCKETS)
+polls = Counter("boiler_polls_total", "CAR polls by result (changed, unchanged or failed).", ("result",))
+alerts_seen = Counter("boiler_alerts_seen_total", "New or changed alerts seen on CAR.")
+alerts_filtered = Counter("boiler_alerts_filtered_total", "Alerts that were not stored, by reason (blocked by a filter, already expired or already stored).", ("reason",))
+alerts_ingested = Counter("boiler_alerts_ingested_total", "Alerts stored and published to the feed.")
+alerts_failed = Counter("boiler_alerts_failed_total", "Alerts that failed to store.")
+alerts_expired = Counter("boiler_alerts_expired_total", "Alerts taken off the feed because they expired, by what happened to them (archived or deleted).", ("action",))
+feed_publishes = Counter("boiler_feed_publishes_total", "Times feed.xml and update.xml were re-written.")
+feed_alerts = Gauge("boiler_feed_alerts", "Alerts on the feed right now.")
+audio_jobs = Gauge("boiler_audio_jobs", "Audio jobs by state, and totals for each outcome since startup.", ("state",))
+http_requests = Counter("boiler_http_requests_total", "Requests answered by this web worker, by route and status code.", ("route", "status"))
+http_seconds = Histogram("boiler_http_request_seconds", "Time taken to answer requests in this web worker, by route.", ("route",))
+
+def stage(name:str):
+    '''Times a with block as the given stage.'''
+    return stage_seconds.time(stage=name)
+
+def render():
+    '''Returns every metric that has a value in the Prometheus text format.'''
+    lines = []
+    with _lock:
+        for metric in _metrics.values():
+            if not metric.values:
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            metric._render(lines)
+    return "\n".join(lines) + "\n" if lines else ""
+
+def snapshot():
+    '''Returns the current values of every metric as plain (picklable) data, for sending to another process.'''
+    with _lock:
+        return {name: {key: ([list(value[0]), value[1], value[2]] if isinstance(value, list) else value) for key, value in metric.values.items()} for name, metric in _metrics.items() if metric.values}
+
+def merge(values:dict):
+    '''Adds metrics from snapshot() in another process (an audio job) to the ones here.'''
+    if not values:
+        return
+    with _lock:
+        for name, keyed in values.items():
+            metric = _metrics.get(name)
+            if metric is None:
+                continue
+            for key, value in keyed.items():
+                metric._merge(key, value)
+
+def reset():
+    with _lock:
+        for metric in _metrics.values():
+            metric.values.clear()
+
+def write(path:str):
+    '''Writes render() to path atomically, so webProcess never reads half a file.'''
+    temp_path = f"{path}.tmp"
+    try:
+        with open(temp_path, "w") as metrics_file:
+            metrics_file.write(render())
+            metrics_file.close()
+        os.replace(temp_path, path)
+    except OSError:
+        log.warning(f"Couldn't write metrics to {path}.", exc_info=True)
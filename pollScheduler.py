@@ -0,0 +1,80 @@
+## pollScheduler decides when boiler polls CAR and when it checks the feed for expired alerts, instead of sleeping a fixed 20 seconds after every loop.
+## Polls are spaced from the start of the previous one so the cadence stays steady no matter how long storing alerts took. After new alerts show up
+## the interval drops for a while (alerts tend to come in bunches), and while CAR is failing it backs off exponentially with a bit of jitter.
+import logging, random, threading, time
+
+log = logging.getLogger(__name__)
+
+POLL = "poll"
+EXPIRY = "expiry"
+
+class PollScheduler:
+    def __init__(self, settings:dict = None):
+        self.interval = 20.0
+        self.burst_interval = 5.0
+        self.burst_duration = 120.0
+        self.backoff_max = 300.0
+        self.backoff_jitter = 0.2
+        self.expiry_interval = 60.0
+        self.next_poll = time.monotonic() # Poll and check expiry right away on startup.
+        self.next_expiry = self.next_poll
+        self.burst_until = 0.0
+        self._wake = threading.Event()
+        if settings:
+            self.configure(settings)
+
+    def configure(self, settings:dict):
+        '''Applies the "polling" section of the config. Takes effect from the next scheduled poll.'''
+        self.interval = max(float(settings.get("interval", self.interval)), 1.0)
+        self.burst_interval = min(max(float(settings.get("burst_interval", self.burst_interval)), 1.0), self.interval)
+        self.burst_duration = max(float(settings.get("burst_duration", self.burst_duration)), 0.0)
+        self.backoff_max = max(float(settings.get("backoff_max", self.backoff_max)), self.interval)
+        self.backoff_jitter = min(max(float(settings.get("backoff_jitter", self.backoff_jitter)), 0.0), 1.0)
+        self.expiry_interval = max(float(settings.get("expiry_interval", self.expiry_interval)), 1.0)
+
+    def bursting(self, now:float = None):
+        return (now if now is not None else time.monotonic()) < self.burst_until
+
+    def new_alerts(self):
+        '''Call when a poll turned up new alerts. Polls at burst_interval until burst_duration has passed without any more.'''
+        if not self.bursting():
+            log.info(f"New alerts, polling every {self.burst_interval} seconds for the next {self.burst_duration} seconds.")
+        self.burst_until = time.monotonic() + self.burst_duration
+
+    def poll_delay(self, failures:int, now:float = None):
+        '''Seconds between the start of the last poll and the next one. Exponential backoff (with jitter) takes over once polls start failing.'''
+        if failures > 0:
+            delay = min(self.interval * (2 ** (failures - 1)), self.backoff_max)
+            return delay * random.uniform(1 - self.backoff_jitter, 1) # Jitter only ever shortens the wait, so backoff_max is a real ceiling.
+        return self.burst_interval if self.bursting(now) else self.interval
+
+    def poll_done(self, started:float, failures:int):
+        '''Schedules the next poll relative to started (time.monotonic() when the poll began). A poll that ran past its slot is followed by the next one right away, not by a catch-up burst.'''
+        delay = self.poll_delay(failures, started)
+        self.next_poll = max(started + delay, time.monotonic())
+        if failures:
+            log.warning(f"CAR has failed {failures} poll(s) in a row, trying again in {delay:.1f} seconds.")
+        else:
+            log.debug(f"Next poll in {self.next_poll - time.monotonic():.1f} seconds.")
+
+    def expiry_done(self):
+        self.next_expiry = time.monotonic() + self.expiry_interval
+
+    def wake(self):
+        '''Cuts the current wait short, for example to poll right away after the config changed.'''
+        self.next_poll = time.monotonic()
+        self._wake.set()
+
+    def wait(self):
+        '''Sleeps until the next poll or expiry check is due and returns which ones are due, as a set of POLL and/or EXPIRY.'''
+        while True:
+            now = time.monotonic()
+            due = set()
+            if now >= self.next_poll:
+                due.add(POLL)
+            if now >= self.next_expiry:
+                due.add(EXPIRY)
+            if due:
+                return due
+            self._wake.wait(min(self.next_poll, self.next_expiry) - now)
+            self._wake.clear()
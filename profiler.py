@@ -0,0 +1,164 @@
+## profiler records what boiler.py spends its time and memory on, for tracking down CPU spikes and slow memory growth on a live instance.
+## A session is started by turning "profiling" on in boiler.cfg or by sending boiler.py SIGUSR1. It runs cProfile over the next few loops (ingest
+## workers and audio jobs included) and takes a tracemalloc snapshot after each one, then writes a report to the logs folder and stops by itself.
+import cProfile, io, glob, logging, os, pstats, shutil, signal, tempfile, threading, tracemalloc
+import datetime as dt
+import audioWorker as aw
+
+log = logging.getLogger(__name__)
+
+PROFILE_DIR = "logs"
+TRACEMALLOC_FRAMES = 1 # Allocations are grouped by the line they happened on. More frames cost more memory while tracing.
+
+_lock = threading.Lock()
+_settings = {"enabled": False, "iterations": 10, "top": 30, "keep": 10}
+_requested = False
+_session = None
+
+class _Session:
+    def __init__(self, iterations:int):
+        self.iterations = iterations
+        self.done = 0
+        self.started = dt.datetime.now()
+        self.profile = cProfile.Profile()
+        self.thread_profiles = []
+        self.started_tracing = not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.first_snapshot = _snapshot()
+        self.last_snapshot = self.first_snapshot
+        self.growth = [] # (iteration, bytes allocated and still alive since the previous one)
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        self.audio_dir = tempfile.mkdtemp(prefix="profile-audio-", dir=PROFILE_DIR)
+
+def _snapshot():
+    '''Takes a tracemalloc snapshot without the memory used by profiling itself, which would otherwise top every report.'''
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, cProfile.__file__),
+        tracemalloc.Filter(False, pstats.__file__),
+        tracemalloc.Filter(False, __file__)
+    ))
+
+def configure(settings:dict):
+    '''Applies the "profiling" section of the config. Turning "enabled" on starts a session. It has to be turned off and on again for another one.'''
+    global _requested
+    with _lock:
+        if settings["enabled"] and not _settings["enabled"]:
+            _requested = True
+        _settings.update(settings)
+
+def install_signal():
+    '''Makes SIGUSR1 start a session, or end the running one early. Does nothing where there is no SIGUSR1 (Windows), or off the main thread where Python doesn't allow signal handlers.'''
+    if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, _on_signal)
+
+def _on_signal(signum, frame):
+    global _requested
+    _requested = True # Picked up at the start of the next loop, nothing else is safe to do in a signal handler.
+
+def loop_start():
+    '''Call at the start of every loop of boiler.main. Starts a session if one was asked for, and resumes profiling the loop if one is running.'''
+    global _requested, _session
+    if _requested:
+        _requested = False
+        if _session:
+            log.info("Profiling stopped early.")
+            _finish()
+        else:
+            _session = _Session(max(int(_settings["iterations"]), 1))
+            aw.profile_dir = _session.audio_dir
+            log.warning(f"Profiling the next {_session.iterations} loop(s). This slows Boiler down until it's done.")
+    if _session:
+        _session.profile.enable()
+
+def loop_end():
+    '''Call at the end of every loop of boiler.main. Pauses profiling while boiler.py waits for the next poll, and writes the report after the last loop of the session.'''
+    if not _session:
+        return
+    _session.profile.disable()
+    _session.done += 1
+    snapshot = _snapshot()
+    grown = sum(stat.size_diff for stat in snapshot.compare_to(_session.last_snapshot, "filename"))
+    _session.growth.append((_session.done, grown))
+    _session.last_snapshot = snapshot
+    log.debug(f"Profiling loop {_session.done} of {_session.iterations}, memory traced by Python changed by {grown / 1024:+.1f} KiB.")
+    if _session.done >= _session.iterations:
+        _finish()
+
+def profiled_call(function, *args, **kwargs):
+    '''Calls function with args, profiling it if a session is running. Used for the ingest workers, since cProfile only sees the thread it was enabled on.'''
+    session = _session
+    if not session:
+        return function(*args, **kwargs)
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError: # Python 3.12+ only allows one profiler at a time, and that one already sees every thread.
+        return function(*args, **kwargs)
+    try:
+        return function(*args, **kwargs)
+    finally:
+        profile.disable()
+        with _lock:
+            session.thread_profiles.append(profile)
+
+def _finish():
+    global _session
+    session, _session = _session, None
+    aw.profile_dir = None
+    session.profile.disable()
+    top = max(int(_settings["top"]), 1)
+    name = f"profile_{session.started:%Y-%m-%d_%H-%M-%S}"
+    path_prof = os.path.join(PROFILE_DIR, f"{name}.prof")
+    path_report = os.path.join(PROFILE_DIR, f"{name}.txt")
+    try:
+        stats = pstats.Stats(session.profile)
+        with _lock:
+            for profile in session.thread_profiles:
+                stats.add(profile)
+        audio_files = glob.glob(os.path.join(session.audio_dir, "*.prof"))
+        audio_stats = pstats.Stats(*audio_files) if audio_files else None
+        stats.dump_stats(path_prof)
+
+        report = io.StringIO()
+        report.write(f"Boiler profile of {session.done} loop(s) from {session.started:%Y-%m-%d %H:%M:%S} to {dt.datetime.now():%Y-%m-%d %H:%M:%S}.\n")
+        report.write(f"{len(session.thread_profiles)} ingest job(s) and {len(audio_files)} audio job(s) were profiled. Full stats are in {path_prof}, open them with 'python -m pstats'.\n\n")
+        for title, profile_stats in (("boiler.py", stats), ("Audio jobs", audio_stats)):
+            if not profile_stats:
+                continue
+            for sort in ("cumulative", "tottime"):
+                report.write(f"===== {title}, top {top} by {sort} time =====\n")
+                profile_stats.stream = report
+                profile_stats.sort_stats(sort).print_stats(top)
+        snapshot = _snapshot()
+        report.write(f"===== Memory, top {top} allocations that grew over the session =====\n")
+        for stat in snapshot.compare_to(session.first_snapshot, "lineno")[:top]:
+            report.write(f"{stat}\n")
+        report.write(f"\n===== Memory, change per loop =====\n")
+        for iteration, grown in session.growth:
+            report.write(f"Loop {iteration}: {grown / 1024:+.1f} KiB\n")
+        current, peak = tracemalloc.get_traced_memory()
+        report.write(f"Traced now: {current / 1024 / 1024:.1f} MiB, peak: {peak / 1024 / 1024:.1f} MiB\n")
+        with open(path_report, "w") as report_file:
+            report_file.write(report.getvalue())
+            report_file.close()
+        log.warning(f"Profiling done, report written to {path_report}.")
+    except:
+        log.error("Couldn't write the profiling report.", exc_info=True)
+    finally:
+        if session.started_tracing:
+            tracemalloc.stop()
+        shutil.rmtree(session.audio_dir, ignore_errors=True)
+    _rotate()
+
+def _rotate():
+    '''Keeps the newest "keep" reports and removes the rest.'''
+    keep = max(int(_settings["keep"]), 1)
+    reports = sorted(glob.glob(os.path.join(PROFILE_DIR, "profile_*.txt")))
+    for path_report in reports[:-keep]:
+        for path in (path_report, path_report[:-len(".txt")] + ".prof"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
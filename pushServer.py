@@ -0,0 +1,227 @@
+## pushServer lets receivers and relays find out about a new feed the moment it's published, instead of waiting for their next poll of update_suffix.
+## It's a small asyncio HTTP server on its own port, so thousands of idle subscribers cost a socket and a coroutine each instead of a web worker thread.
+##   {update_suffix}/stream  Server-Sent Events. An "update" event is sent on connect and every time the feed changes.
+##   {update_suffix}/poll    Long-poll. Send the ETag you have in If-None-Match; the reply (update.xml) comes back as soon as there's something newer, or 304 on timeout.
+## feedManagement sends a UDP datagram to the same port on 127.0.0.1 after every publish. update.xml is also checked every second in case one gets lost.
+import asyncio, atexit, hashlib, json, logging, os, socket, subprocess, sys, coloredlogs
+import xml.etree.ElementTree as ET
+from urllib.parse import urlsplit, parse_qs
+
+log = logging.getLogger(__name__)
+
+CHECK_INTERVAL = 1.0
+REQUEST_TIMEOUT = 10 # Seconds a client gets to send its request headers
+MAX_REQUEST_SIZE = 8192
+
+def push_settings(config:dict):
+    '''Returns web.push from config with the defaults filled in. webProcess reads boiler.cfg as-is, so nothing can be assumed to be there.'''
+    push = config.get("web", {}).get("push", {})
+    return {
+        "enabled": bool(push.get("enabled", False)),
+        "host_address": str(push.get("host_address", "0.0.0.0")),
+        "port": int(push.get("port", 8081)),
+        "keepalive": float(push.get("keepalive", 15)),
+        "long_poll_timeout": float(push.get("long_poll_timeout", 30)),
+        "max_clients": int(push.get("max_clients", 10000))
+    }
+
+## feedManagement side. One datagram per publish, fire and forget.
+_notify_socket = None
+
+def notify(config:dict):
+    '''Tells the push server (if it's enabled) that feed.xml/update.xml were just re-written.'''
+    global _notify_socket
+    settings = push_settings(config)
+    if not settings["enabled"]:
+        return
+    try:
+        if _notify_socket is None:
+            _notify_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            _notify_socket.setblocking(False)
+        _notify_socket.sendto(b"published", ("127.0.0.1", settings["port"]))
+    except OSError:
+        log.debug("Couldn't notify the push server, it will pick up the change on its own.", exc_info=True)
+
+class PushServer:
+    def __init__(self, config:dict):
+        self.settings = push_settings(config)
+        self.update_path = os.path.join(config.get("alerts_dir", "alerts"), "update.xml")
+        self.update_suffix = config.get("web", {}).get("update_suffix", "/IPAWSOPEN_EAS_SERVICE/rest/update")
+        self.current = None # {"etag", "updated", "body"} of the update.xml being served
+        self._stamp = None
+        self._published = None # Resolved (and replaced) every time the feed changes
+        self.clients = 0
+
+    def refresh(self):
+        '''Re-reads update.xml if it changed on disk and wakes up every subscriber if its content is different.'''
+        try:
+            stat = os.stat(self.update_path)
+        except FileNotFoundError:
+            return
+        stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if stamp == self._stamp:
+            return
+        self._stamp = stamp
+        try:
+            with open(self.update_path, "rb") as update_file:
+                body = update_file.read()
+                update_file.close()
+        except FileNotFoundError:
+            return
+        etag = hashlib.sha1(body).hexdigest()[:16] # Same ETag webProcess gives update.xml, so clients can mix the two.
+        if self.current and self.current["etag"] == etag:
+            return
+        updated = None
+        try:
+            for element in ET.fromstring(body):
+                if element.tag.endswith("updated"):
+                    updated = element.text
+        except ET.ParseError:
+            log.warning(f"{self.update_path} couldn't be parsed, subscribers will get an update without a timestamp.")
+        self.current = {"etag": etag, "updated": updated, "body": body}
+        waiting, self._published = self._published, asyncio.get_running_loop().create_future()
+        if waiting and not waiting.done():
+            waiting.set_result(None)
+        log.info(f"Feed published ({etag}), notifying {self.clients} subscriber(s).")
+
+    async def _wait_for_change(self, etag, timeout:float):
+        '''Waits until the feed is something other than etag. Returns True if it changed, False on timeout.'''
+        while self.current is None or self.current["etag"] == etag:
+            try:
+                await asyncio.wait_for(asyncio.shield(self._published), timeout)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def _watch(self):
+        while True:
+            self.refresh()
+            await asyncio.sleep(CHECK_INTERVAL)
+
+    async def _read_request(self, reader:asyncio.StreamReader):
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), REQUEST_TIMEOUT)
+        lines = head.decode("latin-1").split("\r\n")
+        method, target, _ = lines[0].split(" ", 2)
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        return method, target, headers
+
+    async def handle(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        self.clients += 1
+        try:
+            if self.clients > self.settings["max_clients"]:
+                await self._respond(writer, 503, b"Too many subscribers", {"Retry-After": "30"})
+                return
+            try:
+                method, target, headers = await self._read_request(reader)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+                return
+            url = urlsplit(target)
+            if method != "GET":
+                await self._respond(writer, 405, b"Method not allowed", {"Allow": "GET"})
+            elif url.path == f"{self.update_suffix}/stream":
+                await self._stream(writer, headers.get("last-event-id"))
+            elif url.path == f"{self.update_suffix}/poll":
+                etag = headers.get("if-none-match") or parse_qs(url.query).get("etag", [None])[0]
+                await self._long_poll(writer, etag.strip('"').removesuffix("-gz") if etag else None)
+            else:
+                await self._respond(writer, 404, b"Not found")
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        except:
+            log.error("Unexpected error while serving a push client.", exc_info=True)
+        finally:
+            self.clients -= 1
+            writer.close()
+
+    async def _respond(self, writer:asyncio.StreamWriter, status:int, body:bytes = b"", headers:dict = {}, content_type:str = "text/plain"):
+        reasons = {200: "OK", 304: "Not Modified", 404: "Not Found", 405: "Method Not Allowed", 503: "Service Unavailable"}
+        lines = [f"HTTP/1.1 {status} {reasons.get(status, '')}", "Connection: close", "Cache-Control: no-cache"]
+        if status != 304:
+            lines += [f"Content-Type: {content_type}", f"Content-Length: {len(body)}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body if status != 304 else b""))
+        await writer.drain()
+
+    def _event(self):
+        data = json.dumps({"etag": self.current["etag"], "updated": self.current["updated"]})
+        return f"event: update\nid: {self.current['etag']}\ndata: {data}\n\n".encode()
+
+    async def _stream(self, writer:asyncio.StreamWriter, last_event_id):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: keep-alive\r\nX-Accel-Buffering: no\r\n\r\n")
+        writer.write(b"retry: 5000\n\n")
+        await writer.drain()
+        sent = last_event_id # A reconnecting client that's already up to date doesn't get a duplicate event.
+        while True:
+            if self.current and self.current["etag"] != sent:
+                sent = self.current["etag"]
+                writer.write(self._event())
+                await writer.drain()
+            elif not await self._wait_for_change(sent, self.settings["keepalive"]):
+                writer.write(b": keepalive\n\n") # Also how we find out about subscribers that went away.
+                await writer.drain()
+
+    async def _long_poll(self, writer:asyncio.StreamWriter, etag):
+        if not await self._wait_for_change(etag, self.settings["long_poll_timeout"]):
+            await self._respond(writer, 304, headers={"ETag": f'"{etag}"'} if etag else {})
+            return
+        current = self.current
+        await self._respond(writer, 200, current["body"], {"ETag": f'"{current["etag"]}"'}, content_type="application/xml")
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self._published = loop.create_future()
+        server = await asyncio.start_server(self.handle, self.settings["host_address"], self.settings["port"], limit=MAX_REQUEST_SIZE, backlog=1024)
+        await loop.create_datagram_endpoint(lambda: _NotifyProtocol(self), local_addr=("127.0.0.1", self.settings["port"]))
+        log.info(f"Push server listening on {self.settings['host_address']}:{self.settings['port']} ({self.update_suffix}/stream and {self.update_suffix}/poll).")
+        watcher = asyncio.create_task(self._watch())
+        async with server:
+            await server.serve_forever()
+        watcher.cancel()
+
+class _NotifyProtocol(asyncio.DatagramProtocol):
+    def __init__(self, push_server:PushServer):
+        self.push_server = push_server
+
+    def datagram_received(self, data, addr):
+        self.push_server.refresh()
+
+def _raise_file_limit():
+    '''Every subscriber holds a socket open, so allow as many open files as the system lets us.'''
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY else max(soft, 65536), hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+def run(config:dict):
+    '''Runs the push server until the process is stopped.'''
+    coloredlogs.install(level="INFO")
+    _raise_file_limit()
+    try:
+        asyncio.run(PushServer(config).serve())
+    except KeyboardInterrupt:
+        pass
+
+def start(config:dict):
+    '''Starts the push server as its own process, if it's enabled, and stops it again when the calling process exits. Returns the process, or None.
+
+    It's a separate program rather than a multiprocessing child so the gunicorn workers that fork off of webProcess don't inherit it.'''
+    if not push_settings(config)["enabled"]:
+        return None
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__)])
+    owner = os.getpid()
+    def stop():
+        if os.getpid() == owner and process.poll() is None:
+            process.terminate()
+    atexit.register(stop)
+    return process
+
+if __name__ == "__main__":
+    import configManager
+    run(configManager.load())
@@ -1,14 +1,13 @@
-import json, random
+import random
 import datetime as dt
 import alertProcessor as ap
+import configManager
 
 config = {}
 
 def load_config():
     global config
-    with open("boiler.cfg", "r") as config_file:
-        config = json.load(config_file)
-        config_file.close()
+    config = configManager.load()
 
 def get_details():
     alert_id = f"test-" + str(random.randint(1000,9999))
@@ -1,71 +1,249 @@
-from flask import Flask, Response, send_file
-import os, json
+from flask import Flask, Response, send_file, request, g, jsonify
+import os, hashlib, threading, time
+import datetime as dt
+import pushServer
+import feedStore
+import configManager
+import metrics
+import alertIndex
 
 # I threw this together super quickly, it's not anything special except that it forwards the requests made to the feed and update suffixes to the specified alerts directory,
 # and then forwards requests for the individual .xml files and the individual .mp3 files. Feel free to improve, if you'd like.
 
 app = Flask("Boiler")
 
-config = {}
+config = configManager.current() # Routes are registered from this, so changing the suffixes still takes a restart. Everything else is read from configManager.current() per request.
 
-def load_config():
-    global config
-    with open("boiler.cfg") as config_file:
-        config = json.load(config_file)
-        config_file.close()
+## feed.xml and update.xml are held in memory (plain and gzipped) and only re-read when boiler publishes a new version of them, which we notice
+## by their modification time and size changing. At most one stat per document every RELOAD_CHECK_INTERVAL seconds, no matter how many ENDECs are polling.
+RELOAD_CHECK_INTERVAL = 0.25
+CACHE_CONTROL = "public, no-cache" # Receivers may keep a copy, but have to revalidate it (and get a 304) every time.
+_documents = {}
+_documents_lock = threading.Lock()
 
-load_config()
+def _load_document(path:str):
+    '''Returns the cached copy of the document at path, re-reading it only if it changed on disk. Returns None if it doesn't exist.'''
+    now = time.monotonic()
+    document = _documents.get(path)
+    if document and now - document["checked"] < RELOAD_CHECK_INTERVAL:
+        return document
+    with _documents_lock:
+        document = _documents.get(path)
+        if document and now - document["checked"] < RELOAD_CHECK_INTERVAL:
+            return document
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            _documents.pop(path, None)
+            return None
+        generation = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if not document or document["generation"] != generation:
+            with open(path, "rb") as file:
+                body = file.read()
+                file.close()
+            document = feedStore.document(body, dt.datetime.fromtimestamp(stat.st_mtime, tz=dt.timezone.utc))
+            document["generation"] = generation
+        else:
+            document = dict(document) # Readers may be holding the old one, so it's never modified in place.
+        document["checked"] = now
+        _documents[path] = document
+        return document
+
+def _serve_document(path:str, not_found:str = "<error>File not found</error>"):
+    document = feedStore.get(path) or _load_document(path) # In combined mode, anything published since startup is already in memory.
+    if not document:
+        return Response(not_found, status=404, mimetype="application/xml")
+    use_gzip = "gzip" in request.accept_encodings
+    response = Response(document["gzip"] if use_gzip else document["body"], mimetype="application/xml")
+    if use_gzip:
+        response.headers["Content-Encoding"] = "gzip"
+        response.set_etag(f"{document['etag']}-gz") # Each encoding is its own representation, so they can't share an ETag.
+    else:
+        response.set_etag(document["etag"])
+    response.last_modified = document["last_modified"]
+    response.headers["Cache-Control"] = CACHE_CONTROL
+    response.vary.add("Accept-Encoding")
+    return response.make_conditional(request) # Turns into a 304 if If-None-Match/If-Modified-Since say they already have it.
 
 @app.route(config["web"]["feed_suffix"], methods=["GET"])
 def get_feed():
-    alerts_dir = config.get("alerts_dir")
+    alerts_dir = configManager.current().get("alerts_dir")
     xml_path = os.path.join(alerts_dir, "feed.xml")
-    try:
-        return send_file(xml_path, mimetype="application/xml")
-    except FileNotFoundError:
-        return Response("<error>File not found</error>", status=404, mimetype="application/xml")
+    return _serve_document(xml_path)
 
 @app.route(config["web"]["update_suffix"], methods=["GET"])
 def get_update():
-    alerts_dir = config.get("alerts_dir")
+    alerts_dir = configManager.current().get("alerts_dir")
     xml_path = os.path.join(alerts_dir, "update.xml")
-    try:
-        return send_file(xml_path, mimetype="application/xml")
-    except FileNotFoundError:
-        return Response("<error>File not found</error>", status=404, mimetype="application/xml")
+    return _serve_document(xml_path)
 
 @app.route(f"{config['web']['alerts_suffix']}/<alert_id>/alert.xml", methods=["GET"])
 def get_alert(alert_id):
-    alerts_dir = config.get("alerts_dir")
+    alerts_dir = configManager.current().get("alerts_dir")
     alert_path = os.path.join(alerts_dir, alert_id, "alert.xml")
 
+    if feedStore.get(alert_path):
+        return _serve_document(alert_path, not_found="<error>Alert not found</error>")
     if os.path.exists(alert_path):
         return send_file(alert_path, mimetype="application/xml")
     else:
         return Response("<error>Alert not found</error>", status=404, mimetype="application/xml")
     
-@app.route(f"{config['web']['alerts_suffix']}/<alert_id>/eas-audio.mp3", methods=["GET"])
-def get_alert_audio(alert_id):
-    alerts_dir = config.get("alerts_dir")
-    alert_path = os.path.join(alerts_dir, alert_id, "eas-audio.mp3")
+## Alert audio is handed to send_file() by path, so under a WSGI server with wsgi.file_wrapper it goes out through sendfile() without being copied
+## through Python, and Range requests get a 206. The strong ETag is a hash of the file contents, worked out once per file and cached along with
+## its stat so that at alert time (when every receiver asks for the same MP3 at once) each request is a dict lookup.
+AUDIO_CHECK_INTERVAL = 1.0
+AUDIO_MAX_AGE = 300
+_audio_files = {}
+_audio_files_lock = threading.Lock()
 
-    if os.path.exists(alert_path):
-        return send_file(alert_path, mimetype="audio/mpeg")
-    else:
+def _hash_file(path:str):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+        file.close()
+    return digest.hexdigest()[:32]
+
+def _audio_file(path:str):
+    '''Returns the cached metadata for an audio file, or None if it doesn't exist. The file is only re-hashed if it was replaced.'''
+    now = time.monotonic()
+    audio_file = _audio_files.get(path)
+    if audio_file and now - audio_file["checked"] < AUDIO_CHECK_INTERVAL:
+        return audio_file
+    with _audio_files_lock:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            _audio_files.pop(path, None)
+            return None
+        generation = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if not audio_file or audio_file["generation"] != generation:
+            audio_file = {"generation": generation, "etag": _hash_file(path)}
+        else:
+            audio_file = dict(audio_file)
+        audio_file["checked"] = now
+        _audio_files[path] = audio_file
+        if len(_audio_files) > 1024: # Expired alerts never get asked for again, so don't hang on to them forever.
+            oldest = min(_audio_files, key=lambda key: _audio_files[key]["checked"])
+            del _audio_files[oldest]
+        return audio_file
+
+def _serve_audio(alert_id:str, filename:str):
+    alerts_dir = configManager.current().get("alerts_dir")
+    alert_path = os.path.join(alerts_dir, alert_id, filename)
+    audio_file = _audio_file(alert_path)
+    if not audio_file:
+        return Response("<error>Alert not found</error>", status=404, mimetype="application/xml")
+    try:
+        return send_file(alert_path, mimetype="audio/mpeg", conditional=True, etag=audio_file["etag"], max_age=AUDIO_MAX_AGE)
+    except FileNotFoundError: # Expired between the check and now.
         return Response("<error>Alert not found</error>", status=404, mimetype="application/xml")
 
+@app.route(f"{config['web']['alerts_suffix']}/<alert_id>/eas-audio.mp3", methods=["GET"])
+def get_alert_audio(alert_id):
+    return _serve_audio(alert_id, "eas-audio.mp3")
+
 @app.route(f"{config['web']['alerts_suffix']}/<alert_id>/source-audio.mp3", methods=["GET"])
 def get_alert_source_audio(alert_id):
-    alerts_dir = config.get("alerts_dir")
-    alert_path = os.path.join(alerts_dir, alert_id, "source_audio.mp3")
+    return _serve_audio(alert_id, "source-audio.mp3")
 
-    if os.path.exists(alert_path):
-        return send_file(alert_path, mimetype="audio/mpeg")
-    else:
-        return Response("<error>Alert not found</error>", status=404, mimetype="application/xml")
+## Request metrics for this process. boiler.py writes its own metrics (polls, stages, alert-to-feed latency) to the metrics file, and /metrics
+## serves both. Under gunicorn each scrape is answered by one worker, so the request metrics are only that worker's.
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    route = request.endpoint or "unmatched"
+    started = g.get("started")
+    if started is not None:
+        metrics.http_seconds.observe(time.perf_counter() - started, route=route)
+    metrics.http_requests.inc(route=route, status=response.status_code)
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    metrics_config = configManager.current()["metrics"]
+    if not metrics_config["enabled"]:
+        return Response("Metrics are disabled.\n", status=404, mimetype="text/plain")
+    body = metrics.render()
+    if feedStore.enabled: # Combined mode, the ingest loop records into this same registry, and the file would just repeat it.
+        return Response(body, mimetype="text/plain; version=0.0.4")
+    try:
+        with open(metrics_config["path"], "r") as metrics_file:
+            body += metrics_file.read()
+            metrics_file.close()
+    except FileNotFoundError: # boiler.py hasn't finished its first loop yet, or isn't running.
+        pass
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
+@app.route("/api/alerts", methods=["GET"])
+def query_alerts():
+    '''Searches the alert index. Takes the same filters as 'python3 alertIndex.py query' as query parameters: event, originator, callsign, fips,
+    state, status, since, until, limit and offset.'''
+    index_config = configManager.current()["index"]
+    if not index_config["enabled"]:
+        return jsonify({"error": "The alert index is disabled."}), 404
+    filters = {name: request.args.get(name) for name in ("event", "originator", "callsign", "fips", "state", "status", "since", "until")}
+    try:
+        result = alertIndex.query(index_config["path"], limit=request.args.get("limit", 100), offset=request.args.get("offset", 0), **filters)
+    except ValueError as e: # A time or number that doesn't parse.
+        return jsonify({"error": str(e)}), 400
+    return jsonify(result)
 
 
+def run_production(host_address:str, host_port:int, workers:int, threads:int, post_worker_init = None):
+    '''Serves the app with gunicorn: several worker processes, each answering requests on a pool of threads. post_worker_init(worker) is called in each worker once it's ready. Returns False if gunicorn isn't installed.'''
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        return False
+
+    class BoilerServer(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{host_address}:{host_port}")
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", threads)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("keepalive", 5) # ENDECs poll every few seconds, so keep their connections around.
+            self.cfg.set("accesslog", None)
+            if post_worker_init:
+                self.cfg.set("post_worker_init", post_worker_init)
+
+        def load(self):
+            return app
+
+    BoilerServer().run()
+    return True
+
+def start_ingest(worker = None):
+    '''Runs boiler.py's ingest loop on a thread of this process, for combined mode. Everything it publishes goes into feedStore for the routes to serve.'''
+    import boiler
+    boiler.setup_logger(root_script=True) # Same console and file logging as running boiler.py.
+    feedStore.enabled = True
+    threading.Thread(target=boiler.main, name="ingest", daemon=True).start()
+
 if __name__ == "__main__":
     host_address = config["web"]["flask"]["host_address"]
     host_port = config["web"]["flask"]["host_port"]
-    app.run(host=host_address, port=host_port, debug=True)
+    server = config["web"]["server"]
+    pushServer.start(config)
+    if server["mode"] == "combined":
+        ## One process does everything: a single gunicorn worker runs the ingest loop next to the routes. boiler.py must not also be running as its own service.
+        threads = server["threads"]
+        print(f"Starting Boiler in combined mode on {host_address}:{host_port} with {threads} thread(s).")
+        if not run_production(host_address, host_port, 1, threads, post_worker_init=start_ingest):
+            print("gunicorn is not installed, falling back to the Flask development server! Run 'pip install -r requirements.txt' to fix this.")
+            start_ingest()
+            app.run(host=host_address, port=host_port, threaded=True)
+    elif server["mode"] == "production":
+        workers = server["workers"] or (os.cpu_count() or 1) * 2 + 1
+        threads = server["threads"]
+        print(f"Starting Boiler web service on {host_address}:{host_port} with {workers} worker(s) and {threads} thread(s) each.")
+        if not run_production(host_address, host_port, workers, threads):
+            print("gunicorn is not installed, falling back to the Flask development server! Run 'pip install -r requirements.txt' to fix this.")
+            app.run(host=host_address, port=host_port, threaded=True)
+    else:
+        app.run(host=host_address, port=host_port, debug=True)